@@ -20,8 +20,11 @@ else:
         DATABASE_URL,
         pool_pre_ping=True,   # validate connections before use to avoid stale sockets
         pool_recycle=280,     # recycle before Neon's ~5 min idle timeout
-        pool_size=5,
-        max_overflow=10,
+        # Per worker process: raise for webhook bursts only while
+        # workers * (pool_size + max_overflow) stays under the database's connection limit
+        pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
     )
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
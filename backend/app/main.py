@@ -2,6 +2,8 @@ import os
 import logging
 from dotenv import load_dotenv
 import dspy
+import httpx
+import litellm
 from pathlib import Path
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
@@ -44,7 +46,23 @@ else:
 
 default_lm = dspy.LM(default_model, max_tokens=3200,api_key=os.getenv(provider+'_API_KEY'), temperature=1, cache=False)
 
-dspy.configure(lm=default_lm)
+# Bounds the worker threads behind dspy.asyncify (chart generation modules)
+dspy.configure(lm=default_lm, async_max_workers=int(os.getenv("DSPY_ASYNC_MAX_WORKERS", "16")))
+
+# One keep-alive connection pool shared by all LiteLLM OpenAI-compatible calls,
+# sync (Predict) and async (acall), instead of a pool per cached client
+_llm_http_limits = httpx.Limits(
+    max_connections=int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "200")),
+    max_keepalive_connections=int(os.getenv("LLM_HTTP_MAX_KEEPALIVE", "100")),
+)
+litellm.client_session = httpx.Client(limits=_llm_http_limits, timeout=600.0)
+litellm.aclient_session = httpx.AsyncClient(limits=_llm_http_limits, timeout=600.0)
+
+
+@app.on_event("shutdown")
+async def _close_llm_http_clients():
+    litellm.client_session.close()
+    await litellm.aclient_session.aclose()
 
 # CORS middleware - allow frontend to access backend
 frontend_url = os.getenv("FRONTEND_URL", "http://localhost:5173")
@@ -111,6 +129,15 @@ app.include_router(plans_router)
 if os.getenv("AUTO_MIGRATE", "1") == "1":
     Base.metadata.create_all(bind=engine)
     
+    # create_all leaves existing tables alone, so indexes added to the models later
+    # (e.g. ix_subscriptions_user_created) are created here if they're missing
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except Exception as e:
+                logging.warning(f"Could not create index {index.name} on {table.name}: {e}")
+    
     # Initialize default subscription plans
     from .services.plan_service import plan_service
     from .core.db import SessionLocal
@@ -1,11 +1,31 @@
-from sqlalchemy import String, Integer, Boolean, ForeignKey, DateTime, Text, JSON, Numeric, Enum, Float
+from sqlalchemy import String, Integer, Boolean, ForeignKey, DateTime, Text, JSON, Numeric, Enum, Float, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.ext.compiler import compiles
 from datetime import datetime
 from decimal import Decimal
 import enum
 from .db import Base
 
 
+class utcnow(FunctionElement):
+    """Database-side current UTC time as a naive timestamp, matching datetime.utcnow() columns."""
+    type = DateTime()
+    inherit_cache = True
+
+
+@compiles(utcnow, "postgresql")
+def _pg_utcnow(element, compiler, **kw):
+    # now() is in the session time zone; store UTC like the Python-side defaults
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+
+@compiles(utcnow)
+def _default_utcnow(element, compiler, **kw):
+    # SQLite's CURRENT_TIMESTAMP is already UTC
+    return "CURRENT_TIMESTAMP"
+
+
 class TransactionType(str, enum.Enum):
     """Credit transaction types"""
     RESET = "reset"
@@ -37,18 +57,26 @@ class User(Base):
 
 class Subscription(Base):
     __tablename__ = "subscriptions"
+    __table_args__ = (
+        # Covers get_user_subscription: latest subscription per user, scanned backwards
+        Index("ix_subscriptions_user_created", "user_id", "created_at"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
     plan_id: Mapped[int | None] = mapped_column(ForeignKey("subscription_plans.id"), nullable=True)
     status: Mapped[str] = mapped_column(String(50), default="inactive")
-    stripe_customer_id: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    stripe_customer_id: Mapped[str | None] = mapped_column(String(255), nullable=True, index=True)  # Webhook lookups
     stripe_subscription_id: Mapped[str | None] = mapped_column(String(255), nullable=True)
     current_period_start: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
     current_period_end: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
     cancel_at_period_end: Mapped[bool] = mapped_column(Boolean, default=False)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
-    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Stamped by the database on every UPDATE, so writers don't send a timestamp. Inserts keep
+    # the Python default: create_all never adds the server default to existing tables.
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime, default=datetime.utcnow, server_default=utcnow(), onupdate=utcnow()
+    )
 
     user: Mapped[User] = relationship(back_populates="subscriptions")
     plan: Mapped["SubscriptionPlan"] = relationship(back_populates="subscriptions")
@@ -156,12 +184,16 @@ class PublicDashboard(Base):
 
 class SubscriptionPlan(Base):
     __tablename__ = "subscription_plans"
+    __table_args__ = (
+        # Covers get_all_active_plans: filter on is_active, ordered by sort_order
+        Index("ix_plans_active_sort", "is_active", "sort_order"),
+    )
     
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
     name: Mapped[str] = mapped_column(String(100), unique=True, index=True)
-    stripe_price_id: Mapped[str | None] = mapped_column(String(255), nullable=True)  # Legacy field, use stripe_price_id_monthly
-    stripe_price_id_monthly: Mapped[str | None] = mapped_column(String(255), nullable=True)
-    stripe_price_id_yearly: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    stripe_price_id: Mapped[str | None] = mapped_column(String(255), nullable=True, index=True)  # Legacy field, use stripe_price_id_monthly
+    stripe_price_id_monthly: Mapped[str | None] = mapped_column(String(255), nullable=True, index=True)
+    stripe_price_id_yearly: Mapped[str | None] = mapped_column(String(255), nullable=True, index=True)
     stripe_product_id: Mapped[str | None] = mapped_column(String(255), nullable=True)
     price_monthly: Mapped[Decimal] = mapped_column(Numeric(10, 2), default=0.0)
     price_yearly: Mapped[Decimal | None] = mapped_column(Numeric(10, 2), nullable=True)
@@ -217,3 +249,12 @@ class CreditTransaction(Base):
     user: Mapped[User] = relationship(back_populates="credit_transactions")
 
 
+
+
+class StripeEvent(Base):
+    """Stripe webhook events already processed, used to skip duplicate deliveries"""
+    __tablename__ = "stripe_events"
+    
+    event_id: Mapped[str] = mapped_column(String(255), primary_key=True)
+    event_type: Mapped[str | None] = mapped_column(String(100), nullable=True)
+    processed_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
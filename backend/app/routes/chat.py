@@ -21,6 +21,25 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/chat", tags=["chat"])
 
+# Stateless between calls, so one instance serves all concurrent chat requests
+chat_fn = chat_function()
+
+# Canonical router query_type -> query_type stored with chat messages
+_DB_QUERY_TYPES = {
+    "plotly_edit_query": "edit",
+    "add_chart_query": "add",
+    "data_query": "data_analysis",
+    "general_query": "general_qa",
+    "need_more_clarity": "need_clarity",
+}
+
+# Response field holding executable code -> code_type reported to the client
+_CODE_FIELDS = (
+    ("edited_code", "plotly_edit"),
+    ("chart_code", "add_chart_query"),
+    ("code", "analysis"),
+)
+
 
 @router.post("/send", response_model=ChatResponse)
 def chat_send(payload: ChatRequest, user_sub: str = Depends(get_current_subject)):
@@ -44,7 +63,7 @@ async def chat(
             data_context = dataset_service.get_context(current_user.id, payload.dataset_id) or ""
             # If context not available, try to get basic info
             if not data_context:
-                df = dataset_service.get_dataset(current_user.id, payload.dataset_id)
+                df = await dataset_service.get_dataset_async(current_user.id, payload.dataset_id)
                 if df is not None:
                     if isinstance(df, dict):
                         sheet_names = list(df.keys())
@@ -61,7 +80,9 @@ async def chat(
         matched_chart_info = None
         
         if payload.dataset_id:
-            charts = dataset_service._store.get(current_user.id, {}).get(payload.dataset_id, {}).get("charts", {})
+            dataset_entry = dataset_service._entry(current_user.id, payload.dataset_id)
+            chart_list = dataset_entry.charts if dataset_entry else []
+            charts = {idx: c for idx, c in enumerate(chart_list) if c is not None}
             
             if charts:
                 # Compress chart metadata to 200 chars for matching
@@ -148,9 +169,6 @@ async def chat(
             else:
                 fig_data = str(payload.fig_data)
         
-        # Initialize chat_function
-        chat_fn = chat_function()
-        
         # Use default model from environment (configured in main.py) for main chat
         # No need to set up lm here, it uses dspy.configure(lm=default_lm) from main.py
         
@@ -167,43 +185,24 @@ async def chat(
         
         # Map route query_type to DB query_type
         route_query_type = getattr(route_info, 'query_type', '') if hasattr(route_info, 'query_type') else route_info.get('query_type', '')
-        db_query_type = None
-        if 'plotly_edit_query' in route_query_type:
-            db_query_type = "edit"
-        elif 'add_chart_query' in route_query_type:
-            db_query_type = "add"
-        elif 'data_query' in route_query_type:
-            db_query_type = "data_analysis"
-        elif 'general_query' in route_query_type:
-            db_query_type = "general_qa"
-        elif 'need_more_clarity' in route_query_type:
-            db_query_type = "need_clarity"
+        db_query_type = _DB_QUERY_TYPES.get(route_query_type)
         
         # Format the reply based on response type
         reply = ""
         code_type = None
         executable_code = None
         
+        code_field = next(
+            ((field, kind) for field, kind in _CODE_FIELDS if hasattr(response_obj, field)),
+            None
+        )
+        
         if hasattr(response_obj, 'answer'):
             reply = str(response_obj.answer)
-        elif hasattr(response_obj, 'edited_code'):
-            # Plotly edit code
-            code_type = 'plotly_edit'
-            executable_code = str(response_obj.edited_code)
-            reply = f"```python\n{executable_code}\n```"
-            if hasattr(response_obj, 'reasoning'):
-                reply = f"{str(response_obj.reasoning)}\n\n{reply}"
-        elif hasattr(response_obj, 'chart_code'):
-            # Add chart query - chart code for new chart
-            code_type = 'add_chart_query'
-            executable_code = str(response_obj.chart_code)
-            reply = f"```python\n{executable_code}\n```"
-            if hasattr(response_obj, 'reasoning'):
-                reply = f"{str(response_obj.reasoning)}\n\n{reply}"
-        elif hasattr(response_obj, 'code'):
-            # Analysis code
-            code_type = 'analysis'
-            executable_code = str(response_obj.code)
+        elif code_field:
+            # Plotly edit, new chart or analysis code
+            field, code_type = code_field
+            executable_code = str(getattr(response_obj, field))
             reply = f"```python\n{executable_code}\n```"
             if hasattr(response_obj, 'reasoning'):
                 reply = f"{str(response_obj.reasoning)}\n\n{reply}"
@@ -266,7 +265,7 @@ async def retry_code_generation(
     """
     try:
         # Get dataset for validation
-        df = dataset_service.get_dataset(current_user.id, request.dataset_id)
+        df = await dataset_service.get_dataset_async(current_user.id, request.dataset_id)
         if df is None:
             raise HTTPException(status_code=404, detail="Dataset not found")
         
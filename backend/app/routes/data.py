@@ -1,5 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from sqlalchemy.orm import Session
 from typing import Dict, Any, Optional
 from pydantic import BaseModel
@@ -36,7 +36,7 @@ from ..models import User, Dataset as DatasetModel
 def clean_dataframe_for_json(df):
     """Replace NaN, inf, and -inf with None for JSON serialization"""
     return df.replace({np.nan: None, np.inf: None, -np.inf: None})
-from ..services.dataset_service import dataset_service
+from ..services.dataset_service import dataset_service, utcnow
 from ..schemas.chat import FixVisualizationRequest
 from ..services.agents import fix_plotly, clean_plotly_code, plotly_editor, plotly_adder_sig, ChartInsightsSignature
 from ..services.chart_creator import execute_plotly_code
@@ -622,7 +622,7 @@ async def load_sample_data(
             db.refresh(existing_dataset)
             
             # Store in in-memory data store (for fast access)
-            info = dataset_service.store_dataset(
+            info = await dataset_service.store_dataset_async(
                 user_id=current_user.id,
                 dataset_id=dataset_id,
                 df=df,
@@ -633,9 +633,10 @@ async def load_sample_data(
             # If context already exists, load it into memory
             if existing_dataset.context and existing_dataset.context_status == "completed":
                 # Context exists in DB, load it into memory
-                if current_user.id in dataset_service._store and dataset_id in dataset_service._store[current_user.id]:
-                    dataset_service._store[current_user.id][dataset_id]["context"] = existing_dataset.context
-                    dataset_service._store[current_user.id][dataset_id]["context_status"] = "completed"
+                dataset_entry = dataset_service._entry(current_user.id, dataset_id)
+                if dataset_entry:
+                    dataset_entry.context = existing_dataset.context
+                    dataset_entry.context_status = "completed"
                 
                 return {
                     "message": "Sample data loaded successfully with pre-generated context.",
@@ -681,7 +682,7 @@ async def load_sample_data(
             if any_sample_with_context:
                 db_dataset.context = any_sample_with_context.context
                 db_dataset.context_status = "completed"
-                db_dataset.context_generated_at = datetime.utcnow()
+                db_dataset.context_generated_at = utcnow()
                 db_dataset.columns_info = any_sample_with_context.columns_info
             
             db.add(db_dataset)
@@ -689,7 +690,7 @@ async def load_sample_data(
             db.refresh(db_dataset)
             
             # Store in in-memory data store (for fast access)
-            info = dataset_service.store_dataset(
+            info = await dataset_service.store_dataset_async(
                 user_id=current_user.id,
                 dataset_id=dataset_id,
                 df=df,
@@ -699,9 +700,10 @@ async def load_sample_data(
             
             # Load existing context into memory if we copied it
             if db_dataset.context_status == "completed":
-                if current_user.id in dataset_service._store and dataset_id in dataset_service._store[current_user.id]:
-                    dataset_service._store[current_user.id][dataset_id]["context"] = db_dataset.context
-                    dataset_service._store[current_user.id][dataset_id]["context_status"] = "completed"
+                dataset_entry = dataset_service._entry(current_user.id, dataset_id)
+                if dataset_entry:
+                    dataset_entry.context = db_dataset.context
+                    dataset_entry.context_status = "completed"
                 
                 return {
                     "message": "Sample data loaded successfully with pre-generated context.",
@@ -850,7 +852,7 @@ async def upload_data(
         db.refresh(db_dataset)
         
         # Store in in-memory data store (for fast access during session)
-        info = dataset_service.store_dataset(
+        info = await dataset_service.store_dataset_async(
             user_id=current_user.id,
             dataset_id=dataset_id,
             df=df,
@@ -1004,7 +1006,7 @@ async def get_dataset_preview(
     """
     Get a preview of the dataset (first N rows).
     """
-    df = dataset_service.get_dataset(current_user.id, dataset_id)
+    df = await dataset_service.get_dataset_async(current_user.id, dataset_id)
     
     if df is None:
         raise HTTPException(status_code=404, detail="Dataset not found")
@@ -1039,7 +1041,7 @@ async def get_full_dataset(
         dataset_id: The dataset identifier
         limit: Optional limit on number of rows (default: 5000, use 0 for unlimited)
     """
-    df = dataset_service.get_dataset(current_user.id, dataset_id)
+    df = await dataset_service.get_dataset_async(current_user.id, dataset_id)
     
     if df is None:
         raise HTTPException(status_code=404, detail="Dataset not found")
@@ -1105,7 +1107,7 @@ async def prepare_dataset_context(
         }
     
     # Get the dataset
-    df = dataset_service.get_dataset(current_user.id, dataset_id)
+    df = await dataset_service.get_dataset_async(current_user.id, dataset_id)
     if df is None:
         raise HTTPException(status_code=404, detail="Dataset not found")
     
@@ -1141,13 +1143,13 @@ async def analyze_data(
     
     # Get the dataset
     if request.dataset_id:
-        df = dataset_service.get_dataset(current_user.id, request.dataset_id)
+        df = await dataset_service.get_dataset_async(current_user.id, request.dataset_id)
         if df is None:
             raise HTTPException(status_code=404, detail="Dataset not found")
         dataset_id = request.dataset_id
     else:
         # Use the most recent dataset
-        result = dataset_service.get_latest_dataset(current_user.id)
+        result = await dataset_service.get_latest_dataset_async(current_user.id)
         if result is None:
             raise HTTPException(
                 status_code=400,
@@ -1852,7 +1854,7 @@ async def fix_visualization_error(
         if request.dataset_id:
             try:
                 # Get the dataset
-                df = dataset_service.get_dataset(current_user.id, request.dataset_id)
+                df = await dataset_service.get_dataset_async(current_user.id, request.dataset_id)
                 
                 if df is not None:
                     # Execute the fixed code
@@ -1949,7 +1951,7 @@ async def execute_code(
             }
         )
     
-    df = dataset_service.get_dataset(current_user.id, dataset_id)
+    df = await dataset_service.get_dataset_async(current_user.id, dataset_id)
     if df is None:
         raise HTTPException(status_code=404, detail="Dataset not found")
     
@@ -2155,7 +2157,7 @@ async def edit_chart(
         
         if not data_context:
             # Provide basic fallback context if not available
-            df = dataset_service.get_dataset(current_user.id, request.dataset_id)
+            df = await dataset_service.get_dataset_async(current_user.id, request.dataset_id)
             if df is None:
                 raise HTTPException(status_code=404, detail="Dataset not found")
             
@@ -2169,7 +2171,7 @@ async def edit_chart(
                 data_context = f"Dataset with {len(df)} rows and {len(df.columns)} columns. Columns: {', '.join(columns)}"
         else:
             # Get dataset for execution
-            df = dataset_service.get_dataset(current_user.id, request.dataset_id)
+            df = await dataset_service.get_dataset_async(current_user.id, request.dataset_id)
             if df is None:
                 raise HTTPException(status_code=404, detail="Dataset not found")
         
@@ -2261,7 +2263,7 @@ async def edit_kpi(
     current_user = credits.user
     try:
         # Get dataset
-        df = dataset_service.get_dataset(current_user.id, request.dataset_id)
+        df = await dataset_service.get_dataset_async(current_user.id, request.dataset_id)
         if df is None:
             raise HTTPException(status_code=404, detail="Dataset not found")
         
@@ -2334,7 +2336,7 @@ async def add_kpi(
     current_user = credits.user
     try:
         # Get dataset
-        df = dataset_service.get_dataset(current_user.id, request.dataset_id)
+        df = await dataset_service.get_dataset_async(current_user.id, request.dataset_id)
         if df is None:
             raise HTTPException(status_code=404, detail="Dataset not found")
         
@@ -2409,7 +2411,7 @@ async def apply_filter(
     """
     try:
         # Get dataset
-        df = dataset_service.get_dataset(current_user.id, request.dataset_id)
+        df = await dataset_service.get_dataset_async(current_user.id, request.dataset_id)
         if df is None:
             raise HTTPException(status_code=404, detail="Dataset not found")
         
@@ -2491,7 +2493,7 @@ async def add_chart(
     current_user = credits.user
     try:
         # Get dataset
-        df = dataset_service.get_dataset(current_user.id, request.dataset_id)
+        df = await dataset_service.get_dataset_async(current_user.id, request.dataset_id)
         if df is None:
             raise HTTPException(status_code=404, detail="Dataset not found")
         
@@ -2510,19 +2512,8 @@ async def add_chart(
                 data_context = f"Dataset with {len(df)} rows and {len(df.columns)} columns. Columns: {', '.join(columns)}"
         
         # Get next available chart_index
-        dataset_store = dataset_service._store.get(current_user.id, {}).get(request.dataset_id, {})
-        existing_charts = dataset_store.get("charts", {})
-        if existing_charts:
-            # Convert all keys to ints and find max
-            chart_indices = []
-            for k in existing_charts.keys():
-                try:
-                    chart_indices.append(int(k))
-                except (ValueError, TypeError):
-                    continue
-            next_chart_index = max(chart_indices) + 1 if chart_indices else 0
-        else:
-            next_chart_index = 0
+        dataset_entry = dataset_service._entry(current_user.id, request.dataset_id)
+        next_chart_index = len(dataset_entry.charts) if dataset_entry else 0
         
         # Prepare query with color theme if provided
         query = request.query
@@ -2892,7 +2883,7 @@ async def get_public_dashboard(
         Dict with dashboard data or error
     """
     try:
-        result = dataset_service.get_public_dashboard(db, token)
+        result = dataset_service.get_public_dashboard_json(db, token)
         
         if result is None:
             raise HTTPException(status_code=404, detail="Dashboard not found")
@@ -2903,7 +2894,8 @@ async def get_public_dashboard(
                 detail="😢 Sorry! The dashboard was hosted on the free plan and is no longer available. Please ask politely for whoever shared it to upgrade their plan!"
             )
         
-        return result
+        # Pre-serialized and cached by the service; skip response re-encoding
+        return Response(content=result, media_type="application/json")
     except HTTPException:
         raise
     except Exception as e:
@@ -2992,17 +2984,11 @@ async def suggest_query(
     with dspy.context(lm=quick_lm):
         program = dspy.Predict(SuggestQueries)
         
-        # Get dataset from memory
-        data_dict = dataset_service.get_dataset(current_user.id, dataset_id)
-        if not data_dict:
+        # Create dataset context for DSPy from the first sheet (cached per dataset)
+        dataset_context = await dataset_service.get_sample_markdown_async(current_user.id, dataset_id, rows=5)
+        if dataset_context is None:
             raise HTTPException(404, "Dataset not in memory; please re-upload")
         
-        # Extract first sheet/dataframe
-        sheet_name, df = next(iter(data_dict.items()))
-        
-        # Create dataset context for DSPy
-        dataset_context = df.head(5).to_markdown()
-        
         # Generate single suggestion
         result = program(dataset_context=dataset_context)
         suggestion = str(result.suggestion).strip()
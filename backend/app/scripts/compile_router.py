@@ -0,0 +1,117 @@
+"""
+Offline compilation of the chat query router
+Run this script to optimize the router prompt with MIPROv2 and save it where
+chat_function loads it on startup (see CHAT_ROUTER_COMPILED_PATH)
+"""
+import sys
+import os
+from pathlib import Path
+
+# Add parent directory to path to allow imports
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from dotenv import load_dotenv
+
+load_dotenv(dotenv_path=Path(__file__).parent.parent.parent / ".env", override=False)
+
+import dspy
+from app.services.agents import query_router, CHAT_ROUTER_COMPILED_PATH
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+SAMPLE_DATA_CONTEXT = (
+    "Dataset: sales.csv with columns order_id (int), order_date (date), region (str), "
+    "product (str), category (str), quantity (int), unit_price (float), revenue (float)"
+)
+
+# (user_query, expected query_type)
+LABELED_QUERIES = [
+    ("Plot the weekly moving average of revenue", "add_chart_query"),
+    ("Show me a bar chart of sales by region", "add_chart_query"),
+    ("Create a graph showing revenue trends over time", "add_chart_query"),
+    ("Visualize quantity by category as a pie chart", "add_chart_query"),
+    ("Draw a scatter plot of unit price against quantity", "add_chart_query"),
+    ("Add a histogram of order revenue", "add_chart_query"),
+    ("Make it blue", "plotly_edit_query"),
+    ("Change the title to Quarterly Revenue", "plotly_edit_query"),
+    ("Update the chart to show percentages", "plotly_edit_query"),
+    ("Make the bars horizontal", "plotly_edit_query"),
+    ("Remove the legend from this chart", "plotly_edit_query"),
+    ("Increase the font size of the axis labels", "plotly_edit_query"),
+    ("What is the total revenue?", "data_query"),
+    ("Calculate the average unit price per category", "data_query"),
+    ("How many orders are there in the West region?", "data_query"),
+    ("Which product had the highest quantity sold last month?", "data_query"),
+    ("Compare revenue between 2023 and 2024", "data_query"),
+    ("Group revenue by region and sort descending", "data_query"),
+    ("What columns are in this dataset?", "general_query"),
+    ("How do I use this tool?", "general_query"),
+    ("What is a moving average?", "general_query"),
+    ("What does unit_price mean?", "general_query"),
+    ("Can I export my dashboard?", "general_query"),
+    ("asdf", "need_more_clarity"),
+    ("the thing from before", "need_more_clarity"),
+    ("hmm", "need_more_clarity"),
+]
+
+
+def build_trainset():
+    """Build dspy Examples for the router from LABELED_QUERIES"""
+    return [
+        dspy.Example(
+            user_query=user_query,
+            data_context=SAMPLE_DATA_CONTEXT,
+            query_type=query_type
+        ).with_inputs("user_query", "data_context")
+        for user_query, query_type in LABELED_QUERIES
+    ]
+
+
+def query_type_metric(example, pred, trace=None):
+    """1.0 when the predicted route contains the expected label"""
+    return float(example.query_type in str(getattr(pred, "query_type", "")))
+
+
+def main():
+    """Main compilation function"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compile the AutoDash chat query router")
+    parser.add_argument(
+        "--output",
+        default=CHAT_ROUTER_COMPILED_PATH,
+        help="Where to save the compiled router"
+    )
+    parser.add_argument(
+        "--auto",
+        choices=["light", "medium", "heavy"],
+        default="light",
+        help="MIPROv2 optimization budget"
+    )
+
+    args = parser.parse_args()
+
+    # Same model the router uses at request time
+    dspy.configure(lm=dspy.LM('openai/gpt-4o-mini', api_key=os.getenv('OPENAI_API_KEY'), max_tokens=1000, temperature=1))
+
+    try:
+        optimizer = dspy.MIPROv2(metric=query_type_metric, auto=args.auto)
+        compiled = optimizer.compile(
+            dspy.Predict(query_router),
+            trainset=build_trainset(),
+            minibatch=False
+        )
+        compiled.save(args.output)
+        logger.info(f"✓ Compiled router saved to {args.output}")
+    except Exception as e:
+        logger.error(f"Error compiling router: {e}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
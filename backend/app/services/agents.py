@@ -16,6 +16,8 @@ import json
 import logging
 import asyncio
 import re
+import hashlib
+from collections import OrderedDict
 from contextvars import ContextVar
 import os
 # Set up logger for the module
@@ -164,6 +166,45 @@ class query_router(dspy.Signature):
     reasoning = dspy.OutputField(desc="Brief explanation of why this route was chosen")
 
 
+# Router LM shared by every chat request instead of being rebuilt per call
+_ROUTER_LM = dspy.LM('openai/gpt-4o-mini', api_key=os.getenv('OPENAI_API_KEY'), max_tokens=1000, temperature=1)
+
+# Max number of routing decisions remembered by (normalized query, data context)
+ROUTE_CACHE_SIZE = 1024
+
+# Router prompt compiled offline by app/scripts/compile_router.py, loaded when present
+CHAT_ROUTER_COMPILED_PATH = os.getenv(
+    "CHAT_ROUTER_COMPILED_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "chat_router_compiled.json")
+)
+
+
+# Router labels, in the order they were historically matched as substrings
+_QUERY_TYPES = ('data_query', 'plotly_edit_query', 'add_chart_query', 'need_more_clarity', 'general_query')
+_QUERY_TYPE_SET = frozenset(_QUERY_TYPES)
+
+
+def _canonical_query_type(raw) -> str:
+    """Normalize a router label so dispatch can use exact matches.
+    
+    The LM usually returns the bare label; quotes or surrounding text fall back to the
+    substring match the router originally relied on. Unrecognized labels are returned as is.
+    """
+    label = str(raw).strip().strip("'\"`").strip()
+    if label in _QUERY_TYPE_SET:
+        return label
+    return next((query_type for query_type in _QUERY_TYPES if query_type in label), label)
+
+
+def _route_cache_key(user_query, data_context) -> bytes:
+    """Key a routing decision on the whitespace/case-normalized query and its data context."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(" ".join(str(user_query).lower().split()).encode("utf-8"))
+    h.update(b"\x00")
+    h.update(str(data_context).encode("utf-8"))
+    return h.digest()
+
+
 class chat_function(dspy.Module):
     def __init__(self):
         self.plotly_editor_mod = dspy.Predict(plotly_editor)
@@ -176,28 +217,44 @@ class chat_function(dspy.Module):
         self.router = dspy.Predict(query_router)
         # Recheck router (same format, for retry when unclear)
         self.recheck_router = dspy.Predict(query_router)
+        if os.path.exists(CHAT_ROUTER_COMPILED_PATH):
+            try:
+                self.router.load(CHAT_ROUTER_COMPILED_PATH)
+                self.recheck_router.load(CHAT_ROUTER_COMPILED_PATH)
+            except Exception as e:
+                logger.warning(f"Could not load compiled router from {CHAT_ROUTER_COMPILED_PATH}: {e}")
+        # Resolved query_type per repeated query, so repeats skip the router LM call
+        self._route_cache: "OrderedDict[bytes, dspy.Prediction]" = OrderedDict()
 
     async def aforward(self, user_query, fig_data, data_context, plotly_code):
-        with dspy.context(lm=dspy.LM('openai/gpt-4o-mini', api_key=os.getenv('OPENAI_API_KEY'), max_tokens=1000, temperature=1)):
-            route = self.router(user_query=user_query, data_context=data_context)
+        cache_key = _route_cache_key(user_query, data_context)
+        cached = self._route_cache.get(cache_key)
+        if cached is not None:
+            self._route_cache.move_to_end(cache_key)
+            route = dspy.Prediction(query_type=cached.query_type, reasoning=cached.reasoning)
             query_type = route.query_type
+        else:
+            # acall keeps the LM round trips on the event loop instead of blocking it
+            with dspy.context(lm=_ROUTER_LM):
+                route = await self.router.acall(user_query=user_query, data_context=data_context)
+                query_type = _canonical_query_type(route.query_type)
+                
+                # If unclear, try recheck router
+                if query_type == 'need_more_clarity':
+                    recheck_type = _canonical_query_type(
+                        (await self.recheck_router.acall(user_query=user_query, data_context=data_context)).query_type
+                    )
+                    if recheck_type != 'need_more_clarity':
+                        query_type = recheck_type
             
-            # If unclear, try recheck router
-            if 'need_more_clarity' in query_type:
-                recheck = self.recheck_router(user_query=user_query, data_context=data_context)
-                if 'need_more_clarity' not in recheck.query_type:
-                    query_type = recheck.query_type
+            # Unclear routes are not cached so a rephrased retry gets a fresh decision
+            if query_type != 'need_more_clarity':
+                self._route_cache[cache_key] = dspy.Prediction(query_type=query_type, reasoning=getattr(route, 'reasoning', ''))
+                if len(self._route_cache) > ROUTE_CACHE_SIZE:
+                    self._route_cache.popitem(last=False)
         
-        if 'data_query' in query_type:
-            response = self.data_query_mod(user_query=user_query, dataset_context=data_context)
-        elif 'plotly_edit_query' in query_type:
-            response = self.plotly_editor_mod(user_query=user_query, dataset_context=data_context, plotly_code=plotly_code)
-        elif 'add_chart_query' in query_type:
-            response = self.plotly_add_mod(user_query=user_query, dataset_context=data_context)
-        elif 'need_more_clarity' in query_type:
-            response = self.CLARITY_RESPONSE
-        else:
-            response = self.general_qa(user_query=user_query)
+        branch = self._BRANCHES.get(query_type, chat_function._general)
+        response = await branch(self, user_query, data_context, plotly_code)
         
         route.query_type = query_type
         return_dict = {'route': route, 'response': response}
@@ -206,6 +263,29 @@ class chat_function(dspy.Module):
         
         
         return return_dict
+    
+    async def _data_query(self, user_query, data_context, plotly_code):
+        return await self.data_query_mod.acall(user_query=user_query, dataset_context=data_context)
+    
+    async def _plotly_edit(self, user_query, data_context, plotly_code):
+        return await self.plotly_editor_mod.acall(user_query=user_query, dataset_context=data_context, plotly_code=plotly_code)
+    
+    async def _add_chart(self, user_query, data_context, plotly_code):
+        return await self.plotly_add_mod.acall(user_query=user_query, dataset_context=data_context)
+    
+    async def _need_clarity(self, user_query, data_context, plotly_code):
+        return self.CLARITY_RESPONSE
+    
+    async def _general(self, user_query, data_context, plotly_code):
+        return await self.general_qa.acall(user_query=user_query)
+    
+    # Canonical query_type -> branch; anything else is answered as a general question
+    _BRANCHES = {
+        'data_query': _data_query,
+        'plotly_edit_query': _plotly_edit,
+        'add_chart_query': _add_chart,
+        'need_more_clarity': _need_clarity,
+    }
 
 # ============================================================================
 # STYLING INSTRUCTIONS
@@ -1305,11 +1385,11 @@ class PlotlyVisualizationModule(dspy.Module):
         }
         self.fail = FAIL_MESSAGE
     
-    def _load_dataset(self):
+    async def _load_dataset(self):
         """Load dataset from dataset_service using user_id and dataset_id"""
         if self.user_id and self.dataset_id and not self.dataset:
             from .dataset_service import dataset_service
-            self.dataset = dataset_service.get_dataset(self.user_id, self.dataset_id)
+            self.dataset = await dataset_service.get_dataset_async(self.user_id, self.dataset_id)
             if self.dataset:
                 logger.info(f"Loaded dataset {self.dataset_id} for user {self.user_id} - {len(self.dataset)} sheet(s)")
             else:
@@ -1330,7 +1410,7 @@ class PlotlyVisualizationModule(dspy.Module):
             - metadata: additional context
         """
         # Load dataset from dataset_service and set in context variable for metric function
-        self._load_dataset()
+        await self._load_dataset()
         if self.dataset:
             _dataset_context.set(self.dataset)
             logger.info(f"Dataset loaded and set in context for metric evaluation")
@@ -29,7 +29,13 @@ class CreditService:
         """
         return db.query(UserCredits).filter(UserCredits.user_id == user_id).first()
     
-    def get_or_create_user_credits(self, db: Session, user_id: int, plan_id: Optional[int] = None) -> UserCredits:
+    def get_or_create_user_credits(
+        self,
+        db: Session,
+        user_id: int,
+        plan_id: Optional[int] = None,
+        commit: bool = True
+    ) -> UserCredits:
         """
         Get or create credit record for a user. If plan_id is null, assigns free tier.
         
@@ -37,6 +43,7 @@ class CreditService:
             db: Database session
             user_id: User ID
             plan_id: Optional plan ID (if None and credits don't exist, assigns free tier)
+            commit: If False, only flush and leave the commit to the caller
             
         Returns:
             UserCredits object
@@ -97,8 +104,11 @@ class CreditService:
                     last_reset_at=None
                 )
                 db.add(credits)
-            db.commit()
-            db.refresh(credits)
+            if commit:
+                db.commit()
+                db.refresh(credits)
+            else:
+                db.flush()
             logger.info(f"Created credit record for user {user_id} with plan_id={plan_id}")
         elif credits.plan_id is None:
             # Existing credits but no plan_id - assign free tier
@@ -146,8 +156,11 @@ class CreditService:
                     )
                     db.add(transaction)
                 
-                db.commit()
-                db.refresh(credits)
+                if commit:
+                    db.commit()
+                    db.refresh(credits)
+                else:
+                    db.flush()
                 logger.info(f"Assigned free tier to user {user_id} (existing credits record)")
         return credits
     
@@ -271,7 +284,8 @@ class CreditService:
         db: Session,
         user_id: int,
         plan_id: Optional[int] = None,
-        description: str = "Monthly credit reset"
+        description: str = "Monthly credit reset",
+        commit: bool = True
     ) -> UserCredits:
         """
         Reset user credits to their plan limit
@@ -281,11 +295,13 @@ class CreditService:
             user_id: User ID
             plan_id: Optional plan ID (if None, uses current plan)
             description: Description for the transaction
+            commit: If False, only flush so the caller can commit this together
+                with its own changes
             
         Returns:
             Updated UserCredits object
         """
-        credits = self.get_or_create_user_credits(db, user_id, plan_id)
+        credits = self.get_or_create_user_credits(db, user_id, plan_id, commit=commit)
         
         # Get plan details
         if plan_id:
@@ -294,7 +310,7 @@ class CreditService:
             plan = db.query(SubscriptionPlan).filter(SubscriptionPlan.id == credits.plan_id).first()
         else:
             # Default to free tier if no plan
-            plan = db.query(SubscriptionPlan).filter(SubscriptionPlan.name == "Free").first()
+            plan = plan_service.get_plan_by_name(db, "Free")
         
         if not plan:
             raise ValueError(f"No plan found for user {user_id}")
@@ -315,8 +331,11 @@ class CreditService:
             transaction_metadata={"plan_id": plan.id, "plan_name": plan.name, "old_balance": old_balance}
         )
         db.add(transaction)
-        db.commit()
-        db.refresh(credits)
+        if commit:
+            db.commit()
+            db.refresh(credits)
+        else:
+            db.flush()
         
         logger.info(f"Reset credits for user {user_id} to {credits.balance} (plan: {plan.name})")
         return credits
@@ -360,8 +379,14 @@ class CreditService:
         Returns:
             Dictionary with balance, plan info, and limits
         """
-        credits = self.get_user_credits(db, user_id)
-        if not credits:
+        # Credits and their plan in one round trip
+        row = (
+            db.query(UserCredits, SubscriptionPlan)
+            .outerjoin(SubscriptionPlan, SubscriptionPlan.id == UserCredits.plan_id)
+            .filter(UserCredits.user_id == user_id)
+            .first()
+        )
+        if not row:
             return {
                 "balance": 0,
                 "plan_name": None,
@@ -372,9 +397,7 @@ class CreditService:
                 "updated_at": datetime.utcnow().isoformat()
             }
         
-        plan = None
-        if credits.plan_id:
-            plan = db.query(SubscriptionPlan).filter(SubscriptionPlan.id == credits.plan_id).first()
+        credits, plan = row
         
         return {
             "balance": credits.balance,
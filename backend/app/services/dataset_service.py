@@ -3,39 +3,330 @@ Unified dataset service for in-memory storage and context generation.
 Handles dataset storage, retrieval, and asynchronous context generation using DSPy.
 """
 import asyncio
+import functools
+import hashlib
+import itertools
+import json
+import logging
+import os
 import re
-from typing import Dict, Optional, List, Tuple, Any
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional, List, Tuple, Any
 import pandas as pd
 import numpy as np
 import dspy
 from sqlalchemy.orm import Session
 from sqlalchemy import and_
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from ..models import Dataset, DashboardQuery, ChatMessage, PublicDashboard
 from ..core.db import SessionLocal
 from .agents import CreateDatasetContext
 import secrets
 
+logger = logging.getLogger(__name__)
 
+
+# Dedicated pool for DSPy context generation so long-running LM calls don't
+# compete with DB/file IO on the loop's default executor.
+CONTEXT_GEN_MAX_WORKERS = int(os.getenv("CONTEXT_GEN_MAX_WORKERS", "8"))
+_CTX_EXECUTOR = ThreadPoolExecutor(
+    max_workers=CONTEXT_GEN_MAX_WORKERS,
+    thread_name_prefix="ctxgen"
+)
+
+# Per-sheet stats for multi-sheet workbooks are built in parallel on this pool
+# (separate from _CTX_EXECUTOR, whose threads wait on it)
+_SHEET_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="sheetinfo")
+
+# Context requests arriving within this window are sent as one batched DSPy call
+CONTEXT_BATCH_SIZE = int(os.getenv("CONTEXT_BATCH_SIZE", "8"))
+CONTEXT_BATCH_WINDOW_SECONDS = float(os.getenv("CONTEXT_BATCH_WINDOW_MS", "50")) / 1000
+
+# Max number of generated contexts remembered by schema fingerprint
+CONTEXT_CACHE_SIZE = 1024
+
+# Serialized public dashboard responses, keyed by share token
+PUBLIC_DASHBOARD_CACHE_SIZE = 512
+PUBLIC_DASHBOARD_CACHE_TTL = float(os.getenv("PUBLIC_DASHBOARD_CACHE_TTL", "60"))
+
+# Byte budget for DataFrames kept in memory; least recently used datasets spill to disk
+DATASET_MEM_BUDGET = int(os.getenv("DATASET_MEM_BUDGET", str(1024 * 1024 * 1024)))
+DATASET_SPILL_DIR = os.getenv("DATASET_SPILL_DIR", os.path.join(tempfile.gettempdir(), "autodash_datasets"))
+
+# Optional directory shared by all workers (e.g. a tmpfs mount). When set, datasets are
+# written through to it so any worker can serve them without re-parsing the upload.
+DATASET_SHARED_DIR = os.getenv("DATASET_SHARED_DIR")
+
+# Opt-in: keep text columns as Arrow-backed strings (contiguous buffers instead of one
+# Python object per cell). Requires pyarrow, which isn't a hard dependency.
+DATASET_ARROW_STRINGS = os.getenv("DATASET_ARROW_STRINGS", "").lower() in ("1", "true", "yes")
+if DATASET_ARROW_STRINGS:
+    try:
+        pd.StringDtype("pyarrow")
+    except ImportError:
+        logger.warning("DATASET_ARROW_STRINGS is set but pyarrow is not installed; keeping object columns")
+        DATASET_ARROW_STRINGS = False
+
+
+def utcnow() -> datetime:
+    """Current UTC time as a naive datetime (DB columns store naive UTC)."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def utcnow_iso() -> str:
+    """Current UTC time as a timezone-aware ISO string, formatted once at write time."""
+    return datetime.now(timezone.utc).isoformat(timespec="microseconds")
+
+
+# File extension, or a run of spaces/underscores/digits (matched together so that
+# removing digits between separators still leaves a single underscore)
+_CLEAN_NAME_RE = re.compile(r'\.(?:csv|xlsx?|xls)$|[ _\d]+', re.IGNORECASE)
+
+
+# Dataset ids that may name a file in DATASET_SHARED_DIR (ids come from request bodies)
+_SHARED_DATASET_ID_RE = re.compile(r'^[\w-]+$')
+
+
+def _clean_name_repl(match: re.Match) -> str:
+    run = match.group(0)
+    # Extensions and digit-only runs are dropped; any run with a separator becomes one underscore
+    return '' if run[0] == '.' or run.isdigit() else '_'
+
+
+@functools.lru_cache(maxsize=512)
 def clean_sheet_name(name: str) -> str:
     """
     Clean sheet/file name for use as Python variable.
     - Replace spaces with underscore
     - Remove numbers
     - Remove file extension
+    Done in a single regex pass; cached since the same names recur across uploads.
     """
-    # Remove file extension
-    name = re.sub(r'\.(csv|xlsx?|xls)$', '', name, flags=re.IGNORECASE)
-    # Replace spaces with underscore
-    name = name.replace(' ', '_')
-    # Remove numbers
-    name = re.sub(r'\d+', '', name)
-    # Remove multiple underscores
-    name = re.sub(r'_+', '_', name)
-    # Remove leading/trailing underscores
-    name = name.strip('_')
+    # Fast path: an identifier with no digits or stray underscores is already clean
+    if (
+        name.isidentifier()
+        and not any(ch.isdecimal() for ch in name)
+        and '__' not in name
+        and not name.startswith('_')
+        and not name.endswith('_')
+    ):
+        return name
+    name = _CLEAN_NAME_RE.sub(_clean_name_repl, name).strip('_')
     # Ensure not empty
-    return name if name else 'data'
+    return name or 'data'
+
+
+def _chart_slots(charts: List[Optional[Dict[str, Any]]], chart_index: int) -> List[Optional[Dict[str, Any]]]:
+    """
+    Pad a dataset's chart list with None so chart_index is addressable, and return it.
+    """
+    if chart_index >= len(charts):
+        charts.extend([None] * (chart_index + 1 - len(charts)))
+    return charts
+
+
+def clean_sheet_names(names: List[str]) -> List[str]:
+    """clean_sheet_name for a whole list of sheet names."""
+    return [clean_sheet_name(str(name)) for name in names]
+
+
+def optimize_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Downcast columns to shrink the in-memory footprint.
+    Integers keep their width: generated analysis code does arithmetic on these
+    frames, and narrower integers overflow silently.
+    - Floats -> float32 only when every value survives the round trip unchanged
+    - All-string object columns -> string[pyarrow] when DATASET_ARROW_STRINGS is enabled
+    """
+    optimized = {}
+    for col_name, col in df.items():
+        if not isinstance(col.dtype, np.dtype) or col.empty:
+            continue
+        if col.dtype.kind == "f" and col.dtype.itemsize > 4:
+            downcast = col.astype(np.float32)
+            if downcast.astype(col.dtype).equals(col):
+                optimized[col_name] = downcast
+        elif DATASET_ARROW_STRINGS and col.dtype == object and pd.api.types.infer_dtype(col, skipna=True) == "string":
+            optimized[col_name] = col.astype("string[pyarrow]")
+    
+    if not optimized:
+        return df
+    df = df.copy(deep=False)
+    for col_name, col in optimized.items():
+        df[col_name] = col
+    return df
+
+
+def context_fingerprint(df: pd.DataFrame | Dict[str, pd.DataFrame], user_id: Optional[int]) -> Optional[bytes]:
+    """
+    Fingerprint of a dataset for the context cache: the owning user, plus each sheet's
+    name, columns, dtypes, shape and a hash of all its rows (the context quotes shape and
+    statistics, so only identical data may share it). Returns None if the data can't be hashed.
+    """
+    df_dict = df if isinstance(df, dict) else {"data": df}
+    try:
+        payload = {
+            str(name): [
+                [str(col) for col in sheet_df.columns],
+                list(map(str, sheet_df.dtypes.values)),
+                list(sheet_df.shape),
+                hashlib.blake2b(pd.util.hash_pandas_object(sheet_df, index=False).values.tobytes()).hexdigest(),
+            ]
+            for name, sheet_df in df_dict.items()
+        }
+    except TypeError:
+        return None
+    return hashlib.blake2b(json.dumps([user_id, payload], sort_keys=True).encode()).digest()
+
+
+def _build_sheet_info(sheet_df: pd.DataFrame) -> Tuple[dict, dict]:
+    """Build (stored info, prompt info) for one sheet of a dataset's context prompt."""
+    columns = sheet_df.columns.tolist()
+    sample_df = sheet_df.head(2)
+    
+    # pandas' vectorized JSON writer handles numpy scalars, NaN and timestamps,
+    # so sample values and statistics don't need a per-cell Python walk
+    sample_records_clean = json.loads(
+        sample_df.reset_index(drop=True).to_json(orient="records", date_format="iso", double_precision=15, default_handler=str)
+    )
+    stats_clean = json.loads(
+        sheet_df.describe().to_json(orient="columns", date_format="iso", double_precision=15, default_handler=str)
+    ) if len(sheet_df) > 0 else {}
+    
+    info = {
+        "columns": columns,
+        "dtypes": dict(zip(columns, map(str, sheet_df.dtypes.values))),
+        "shape": sheet_df.shape,
+        "sample_values": sample_records_clean,
+        "statistics": stats_clean
+    }
+    prompt = {
+        "columns": columns,
+        "shape": sheet_df.shape,
+        "sample": sample_df.to_markdown()
+    }
+    return info, prompt
+
+
+def _atomic_write(path: str, write: Callable[[str], None]) -> None:
+    """Write a file through a temporary sibling so readers never see a partial file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+class DatasetHandle:
+    """
+    Holds a dataset's sheets ({sheet_name: DataFrame}) either in memory or
+    spilled to a pickle file on disk. Loaded transparently on access.
+    """
+    
+    def __init__(self, data: Optional[Dict[str, pd.DataFrame]]):
+        self._data: Optional[Dict[str, pd.DataFrame]] = data
+        self._path: Optional[str] = None
+        # Write-through copy in DATASET_SHARED_DIR, readable by every worker
+        self._shared_path: Optional[str] = None
+        # Serializes load/spill of this handle; the service also holds it while
+        # registering the handle in its LRU, so a spill can't slip in between
+        self.lock = threading.RLock()
+        self.nbytes = self._measure(data) if data is not None else 0
+    
+    @staticmethod
+    def _measure(data: Dict[str, pd.DataFrame]) -> int:
+        return int(sum(sheet_df.memory_usage(deep=True).sum() for sheet_df in data.values()))
+    
+    @classmethod
+    def from_shared(cls, path: str, nbytes: int) -> "DatasetHandle":
+        """Create a handle for sheets another worker wrote to the shared directory."""
+        handle = cls(None)
+        handle._shared_path = path
+        handle.nbytes = nbytes
+        return handle
+    
+    @property
+    def in_memory(self) -> bool:
+        return self._data is not None
+    
+    @property
+    def shared(self) -> bool:
+        return self._shared_path is not None
+    
+    def load(self) -> Dict[str, pd.DataFrame]:
+        """Return the sheets, reading them back from disk if needed."""
+        data = self._data
+        if data is not None:
+            return data
+        with self.lock:
+            if self._data is None:
+                if self._path:
+                    self._data = pd.read_pickle(self._path)
+                    self.discard()
+                else:
+                    self._data = pd.read_pickle(self._shared_path)
+            return self._data
+    
+    def spill(self, directory: str) -> None:
+        """Write the sheets to disk and drop the in-memory copy."""
+        with self.lock:
+            if self._data is None:
+                return
+            # A shared copy already is the on-disk version
+            if self._shared_path is None:
+                os.makedirs(directory, exist_ok=True)
+                self._path = os.path.join(directory, f"{uuid.uuid4().hex}.pkl")
+                pd.to_pickle(self._data, self._path)
+            self._data = None
+    
+    def share(self, path: str) -> None:
+        """Write the loaded sheets to a path other workers can read them back from."""
+        data = self.load()
+        _atomic_write(path, lambda tmp_path: pd.to_pickle(data, tmp_path))
+        self._shared_path = path
+    
+    def discard(self) -> None:
+        """Remove the spill file, if any."""
+        if self._path:
+            try:
+                os.unlink(self._path)
+            except OSError:
+                pass
+            self._path = None
+
+
+@dataclass(slots=True)
+class DatasetEntry:
+    """In-memory record of one stored dataset: its sheets plus upload, context and chart metadata."""
+    df: DatasetHandle  # Always a dict of sheets once loaded
+    filename: str
+    file_type: str
+    is_multisheet: bool
+    sheet_names: List[str]  # Cleaned names
+    uploaded_at: str  # Pre-formatted; fixed-width so it also sorts
+    row_count: int
+    column_count: int
+    columns: list
+    context: Optional[str] = None  # Populated after context generation
+    context_status: str = "pending"
+    refine_attempts: int = 0
+    charts: List[Optional[Dict[str, Any]]] = field(default_factory=list)  # Indexed by chart_index
+    original_dtypes: Optional[Dict[str, Dict[str, str]]] = None  # Pre-downcast dtypes, for debugging
+    # (fingerprint, prompt, sheets_info) from the last context build; a re-upload creates a new entry
+    prompt_cache: Optional[Tuple[bytes, str, dict]] = None
+    db_pk: Optional[int] = None  # Dataset.id, resolved on first use
+    sample_markdown: Dict[Tuple[str, int], str] = field(default_factory=dict)  # {(sheet, rows): markdown}
+    upload_seq: int = 0  # Upload order within this process (0 for entries loaded from the shared dir)
+    shared_mtime_ns: Optional[int] = None  # mtime of the shared metadata this entry last wrote or read
 
 
 class DatasetService:
@@ -45,11 +336,38 @@ class DatasetService:
     """
     
     def __init__(self):
-        # In-memory storage: {user_id: {dataset_id: {df, metadata}}}
-        self._store: Dict[int, Dict[str, dict]] = {}
+        # In-memory storage: {user_id: {dataset_id: DatasetEntry}}
+        self._store: Dict[int, Dict[str, DatasetEntry]] = {}
+        
+        # Most recently uploaded dataset per user: {user_id: dataset_id}
+        self._latest: Dict[int, str] = {}
+        # Monotonic upload counter; orders datasets without comparing timestamps
+        self._upload_seq = itertools.count(1)
+        
+        # Per-user locks guarding compound read-modify-write on _store
+        # (pure reads rely on the GIL)
+        self._user_locks: Dict[int, threading.Lock] = defaultdict(threading.Lock)
+        
+        # LRU order of in-memory datasets for the memory budget: {(user_id, dataset_id): None}
+        self._lru: "OrderedDict[Tuple[int, str], None]" = OrderedDict()
+        self._resident_bytes = 0
+        self._lru_lock = threading.Lock()
         
         # DSPy context generator
         self.context_creator = dspy.Predict(CreateDatasetContext)
+        
+        # Context generation batching (queue/worker created lazily on the running loop)
+        self._pending_ctx: Optional[asyncio.Queue] = None
+        self._ctx_worker: Optional[asyncio.Task] = None
+        self._ctx_batches: set = set()
+        
+        # Generated contexts keyed by context_fingerprint(), so a user's re-uploads skip the LLM
+        self._ctx_cache: "OrderedDict[bytes, str]" = OrderedDict()
+        self._ctx_cache_lock = threading.Lock()
+        
+        # share_token -> (JSON body, dashboard expires_at, cache deadline)
+        self._public_cache: "OrderedDict[str, Tuple[bytes, Optional[datetime], float]]" = OrderedDict()
+        self._public_cache_lock = threading.Lock()
     
     # ==================== Data Storage Methods ====================
     
@@ -68,13 +386,10 @@ class DatasetService:
         For Excel: keeps as dict with cleaned sheet names as keys
         Returns metadata about the stored dataset.
         """
-        if user_id not in self._store:
-            self._store[user_id] = {}
-        
         # Normalize to dict format
         if isinstance(df, dict):
             # Excel: clean sheet names
-            cleaned_data = {clean_sheet_name(name): sheet_df for name, sheet_df in df.items()}
+            cleaned_data = dict(zip(clean_sheet_names(list(df.keys())), df.values()))
             is_multisheet = len(cleaned_data) > 1
         else:
             # CSV: wrap in dict with cleaned filename
@@ -82,6 +397,13 @@ class DatasetService:
             cleaned_data = {cleaned_name: df}
             is_multisheet = False
         
+        # Downcast once on ingest; the frames may stay resident for the whole session
+        original_dtypes = {
+            name: dict(zip(sheet_df.columns.tolist(), map(str, sheet_df.dtypes.values)))
+            for name, sheet_df in cleaned_data.items()
+        }
+        cleaned_data = {name: optimize_dtypes(sheet_df) for name, sheet_df in cleaned_data.items()}
+        
         # Get sheet names and metadata
         sheet_names = list(cleaned_data.keys())
         total_rows = sum(len(sheet_df) for sheet_df in cleaned_data.values())
@@ -91,87 +413,272 @@ class DatasetService:
         columns = first_sheet.columns.tolist()
         column_count = len(columns)
         
-        self._store[user_id][dataset_id] = {
-            "df": cleaned_data,  # Always a dict now
-            "filename": filename,
-            "file_type": file_type,
-            "is_multisheet": is_multisheet,
-            "sheet_names": sheet_names,  # Cleaned names
-            "uploaded_at": datetime.utcnow(),
-            "row_count": total_rows,
-            "column_count": column_count,
-            "columns": columns,
-            "context": None,  # Will be populated after context generation
-            "context_status": "pending",
-            "refine_attempts": 0,
-        }
+        handle = DatasetHandle(cleaned_data)
+        self._put_entry(user_id, dataset_id, DatasetEntry(
+            df=handle,
+            filename=filename,
+            file_type=file_type,
+            is_multisheet=is_multisheet,
+            sheet_names=sheet_names,
+            uploaded_at=utcnow_iso(),
+            row_count=total_rows,
+            column_count=column_count,
+            columns=columns,
+            original_dtypes=original_dtypes,
+        ))
+        
+        self._touch_handle(user_id, dataset_id, handle)
+        self._share_entry(user_id, dataset_id)
         
         return self.get_dataset_info(user_id, dataset_id)
     
+    async def store_dataset_async(
+        self,
+        user_id: int,
+        dataset_id: str,
+        df: pd.DataFrame | Dict[str, pd.DataFrame],
+        filename: str,
+        file_type: str = "csv"
+    ) -> dict:
+        """
+        store_dataset for async callers: downcasting, measuring, spilling and the
+        DATASET_SHARED_DIR write-through run in a worker thread, off the event loop.
+        """
+        return await asyncio.to_thread(self.store_dataset, user_id, dataset_id, df, filename, file_type)
+    
+    def _put_entry(self, user_id: int, dataset_id: str, entry: DatasetEntry) -> None:
+        """Insert a dataset entry, replacing (and releasing) any previous one."""
+        with self._user_locks[user_id]:
+            previous = self._store.get(user_id, {}).get(dataset_id)
+            if previous:
+                self._release_handle(user_id, dataset_id, previous.df)
+            
+            entry.upload_seq = next(self._upload_seq)
+            self._store.setdefault(user_id, {})[dataset_id] = entry
+            # A new upload is always the latest one
+            self._latest[user_id] = dataset_id
+    
+    def _entry(self, user_id: int, dataset_id: str) -> Optional[DatasetEntry]:
+        """
+        Return the in-memory entry for a dataset, or None if it isn't loaded.
+        With DATASET_SHARED_DIR set, a dataset uploaded through another worker is
+        picked up from the shared directory (its sheets load on first access).
+        Until its context is completed, the context is re-read whenever another
+        worker has rewritten the shared metadata.
+        """
+        entry = (self._store.get(user_id) or {}).get(dataset_id)
+        if entry is None:
+            if DATASET_SHARED_DIR:
+                entry = self._load_shared_entry(user_id, dataset_id)
+        elif entry.shared_mtime_ns is not None and entry.context_status != "completed":
+            self._refresh_shared_context(user_id, dataset_id, entry)
+        return entry
+    
+    @staticmethod
+    def _shared_paths(user_id: int, dataset_id: str) -> Optional[Tuple[str, str]]:
+        """
+        Paths of a dataset's sheets (pickle) and metadata (JSON) in DATASET_SHARED_DIR,
+        or None if dataset_id isn't a plain name that stays inside the user's directory.
+        """
+        if not _SHARED_DATASET_ID_RE.match(dataset_id):
+            return None
+        user_dir = os.path.realpath(os.path.join(DATASET_SHARED_DIR, str(user_id)))
+        base = os.path.join(user_dir, dataset_id)
+        paths = f"{base}.pkl", f"{base}.json"
+        # Resolve symlinks too: the files themselves must live in the user's directory
+        if any(os.path.dirname(os.path.realpath(path)) != user_dir for path in paths):
+            return None
+        return paths
+    
+    def _share_entry(self, user_id: int, dataset_id: str) -> None:
+        """
+        Write a dataset through to DATASET_SHARED_DIR: its sheets on first call, then
+        its metadata. Failures are logged; the in-memory copy stays authoritative.
+        """
+        if not DATASET_SHARED_DIR:
+            return
+        entry = (self._store.get(user_id) or {}).get(dataset_id)
+        paths = self._shared_paths(user_id, dataset_id)
+        if entry is None or paths is None:
+            return
+        
+        data_path, meta_path = paths
+        metadata = {
+            "filename": entry.filename,
+            "file_type": entry.file_type,
+            "is_multisheet": entry.is_multisheet,
+            "sheet_names": entry.sheet_names,
+            "uploaded_at": entry.uploaded_at,
+            "row_count": entry.row_count,
+            "column_count": entry.column_count,
+            "columns": entry.columns,
+            "context": entry.context,
+            "context_status": entry.context_status,
+            "nbytes": entry.df.nbytes,
+        }
+        try:
+            if not entry.df.shared:
+                entry.df.share(data_path)
+            payload = json.dumps(metadata, default=str)
+            _atomic_write(meta_path, lambda tmp_path: open(tmp_path, "w").write(payload))
+            entry.shared_mtime_ns = os.stat(meta_path).st_mtime_ns
+        except OSError as e:
+            logger.warning(f"Could not share dataset {dataset_id} to {DATASET_SHARED_DIR}: {e}")
+    
+    def _load_shared_entry(self, user_id: int, dataset_id: str) -> Optional[DatasetEntry]:
+        """Build an entry from the shared directory, or None if the dataset was never shared."""
+        paths = self._shared_paths(user_id, dataset_id)
+        if paths is None:
+            return None
+        data_path, meta_path = paths
+        try:
+            mtime_ns = os.stat(meta_path).st_mtime_ns
+            with open(meta_path) as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):
+            return None
+        
+        handle = DatasetHandle.from_shared(data_path, metadata.pop("nbytes"))
+        entry = DatasetEntry(df=handle, shared_mtime_ns=mtime_ns, **metadata)
+        # Another thread may have loaded it meanwhile; keep whichever landed first
+        return self._store.setdefault(user_id, {}).setdefault(dataset_id, entry)
+    
+    def _refresh_shared_context(self, user_id: int, dataset_id: str, entry: DatasetEntry) -> None:
+        """Pick up context progress another worker wrote to the shared metadata since we last saw it."""
+        paths = self._shared_paths(user_id, dataset_id)
+        if paths is None:
+            return
+        _, meta_path = paths
+        try:
+            mtime_ns = os.stat(meta_path).st_mtime_ns
+            if mtime_ns == entry.shared_mtime_ns:
+                return
+            with open(meta_path) as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):
+            return
+        entry.context = metadata.get("context")
+        entry.context_status = metadata.get("context_status", entry.context_status)
+        entry.shared_mtime_ns = mtime_ns
+    
     def get_dataset(self, user_id: int, dataset_id: str) -> Optional[Dict[str, pd.DataFrame]]:
         """Retrieve a dataset from memory (always returns dict format)"""
-        if user_id in self._store and dataset_id in self._store[user_id]:
-            return self._store[user_id][dataset_id]["df"]
+        entry = self._entry(user_id, dataset_id)
+        if entry:
+            return self._touch_handle(user_id, dataset_id, entry.df)
         return None
+    
+    async def get_dataset_async(self, user_id: int, dataset_id: str) -> Optional[Dict[str, pd.DataFrame]]:
+        """get_dataset for async callers: reloading or spilling frames runs in a worker thread, off the event loop."""
+        return await asyncio.to_thread(self.get_dataset, user_id, dataset_id)
+    
+    def _touch_handle(self, user_id: int, dataset_id: str, handle: DatasetHandle) -> Dict[str, pd.DataFrame]:
+        """Load a dataset (reloading from disk if spilled), mark it most recently used and enforce the budget."""
+        # Disk reads and workbook parsing happen outside the LRU lock so they
+        # don't stall every other dataset access
+        victims = []
+        with handle.lock:
+            data = handle.load()
+            with self._lru_lock:
+                # A dataset is in the LRU exactly while it is resident
+                if (user_id, dataset_id) not in self._lru:
+                    self._resident_bytes += handle.nbytes
+                self._lru[(user_id, dataset_id)] = None
+                self._lru.move_to_end((user_id, dataset_id))
+                
+                # Pick least recently used datasets to spill, never the one just accessed
+                while self._resident_bytes > DATASET_MEM_BUDGET and len(self._lru) > 1:
+                    key, _ = self._lru.popitem(last=False)
+                    entry = (self._store.get(key[0]) or {}).get(key[1])
+                    if entry is None:
+                        continue
+                    self._resident_bytes -= entry.df.nbytes
+                    victims.append((key, entry.df))
+        
+        for key, lru_handle in victims:
+            with lru_handle.lock:
+                # Touched again since it was picked: it is back in the budget, keep it
+                if key not in self._lru:
+                    lru_handle.spill(DATASET_SPILL_DIR)
+        
+        return data
+    
+    def _release_handle(self, user_id: int, dataset_id: str, handle: DatasetHandle) -> None:
+        """Drop a dataset from the memory budget and remove any spill file."""
+        with self._lru_lock:
+            if self._lru.pop((user_id, dataset_id), False) is None:
+                self._resident_bytes -= handle.nbytes
+            handle.discard()
 
     def reset_refine_attempts(self, user_id: int, dataset_id: str) -> None:
         """Reset refine attempt counter for a dataset."""
-        if user_id in self._store and dataset_id in self._store[user_id]:
-            self._store[user_id][dataset_id]["refine_attempts"] = 0
+        with self._user_locks[user_id]:
+            entry = self._entry(user_id, dataset_id)
+            if entry:
+                entry.refine_attempts = 0
 
     def increment_refine_attempt(self, user_id: int, dataset_id: str, limit: int) -> bool:
         """
         Increment refine attempts for a dataset.
         Returns True if under limit, False if limit exceeded.
         """
-        if user_id not in self._store or dataset_id not in self._store[user_id]:
-            return False
-
-        entry = self._store[user_id][dataset_id]
-        attempts = entry.get("refine_attempts", 0)
+        with self._user_locks[user_id]:
+            entry = self._entry(user_id, dataset_id)
+            if not entry:
+                return False
+            if entry.refine_attempts >= limit:
+                return False
 
-        if attempts >= limit:
-            return False
-
-        entry["refine_attempts"] = attempts + 1
-        return True
+            entry.refine_attempts += 1
+            return True
     
     def get_dataset_info(self, user_id: int, dataset_id: str) -> Optional[dict]:
         """Get metadata about a dataset without returning the full DataFrame"""
-        if user_id in self._store and dataset_id in self._store[user_id]:
-            data = self._store[user_id][dataset_id]
-            return {
-                "dataset_id": dataset_id,
-                "filename": data["filename"],
-                "file_type": data.get("file_type", "csv"),
-                "is_multisheet": data.get("is_multisheet", False),
-                "sheet_names": data.get("sheet_names"),
-                "uploaded_at": data["uploaded_at"].isoformat(),
-                "row_count": data["row_count"],
-                "column_count": data["column_count"],
-                "columns": data["columns"],
-                "context": data.get("context"),
-                "context_status": data.get("context_status", "pending"),
-                "refine_attempts": data.get("refine_attempts", 0),
-            }
-        return None
+        entry = self._entry(user_id, dataset_id)
+        return self._entry_info(dataset_id, entry) if entry else None
+    
+    @staticmethod
+    def _entry_info(dataset_id: str, entry: DatasetEntry) -> dict:
+        """Public metadata of an entry, as returned by get_dataset_info."""
+        return {
+            "dataset_id": dataset_id,
+            "filename": entry.filename,
+            "file_type": entry.file_type,
+            "is_multisheet": entry.is_multisheet,
+            "sheet_names": entry.sheet_names,
+            "uploaded_at": entry.uploaded_at,
+            "row_count": entry.row_count,
+            "column_count": entry.column_count,
+            "columns": entry.columns,
+            "context": entry.context,
+            "context_status": entry.context_status,
+            "refine_attempts": entry.refine_attempts,
+        }
     
     def list_datasets(self, user_id: int) -> List[dict]:
         """List all datasets for a user"""
-        if user_id not in self._store:
-            return []
-        
         return [
-            self.get_dataset_info(user_id, dataset_id)
-            for dataset_id in self._store[user_id].keys()
+            self._entry_info(dataset_id, entry)
+            for dataset_id, entry in list((self._store.get(user_id) or {}).items())
         ]
     
     def delete_dataset(self, user_id: int, dataset_id: str) -> bool:
         """Delete a dataset from memory"""
-        if user_id in self._store and dataset_id in self._store[user_id]:
-            del self._store[user_id][dataset_id]
-            return True
-        return False
+        with self._user_locks[user_id]:
+            if self._entry(user_id, dataset_id):
+                entry = self._store[user_id].pop(dataset_id)
+                self._release_handle(user_id, dataset_id, entry.df)
+                if entry.df.shared:
+                    for path in self._shared_paths(user_id, dataset_id) or ():
+                        try:
+                            os.unlink(path)
+                        except OSError:
+                            pass
+                # Recomputed lazily on the next get_latest_dataset call
+                if self._latest.get(user_id) == dataset_id:
+                    del self._latest[user_id]
+                return True
+            return False
     
     # ==================== Chart Metadata Methods ====================
     
@@ -199,33 +706,29 @@ class DatasetService:
             chart_type: Optional chart type (bar_chart, line_chart, etc.)
             title: Optional chart title
         """
-        if user_id not in self._store:
-            self._store[user_id] = {}
-        
-        if dataset_id not in self._store[user_id]:
-            raise ValueError(f"Dataset {dataset_id} not found. Upload dataset first.")
-        
-        dataset = self._store[user_id][dataset_id]
-        
-        # Initialize charts metadata if first time
-        if "charts" not in dataset:
-            dataset["charts"] = {}
-        
-        # Store chart metadata
-        # Preserve existing notes if updating other fields
-        existing_notes = ""
-        if chart_index in dataset.get("charts", {}):
-            existing_notes = dataset["charts"][chart_index].get("notes", "")
-        
-        dataset["charts"][chart_index] = {
-            "chart_spec": chart_spec,
-            "plan": plan,
-            "figure": figure_data,
-            "chart_type": chart_type,
-            "title": title,
-            "notes": existing_notes,
-            "created_at": datetime.utcnow().isoformat()
-        }
+        with self._user_locks[user_id]:
+            dataset = self._entry(user_id, dataset_id)
+            if not dataset:
+                raise ValueError(f"Dataset {dataset_id} not found. Upload dataset first.")
+        
+            # Charts are a dense list indexed by chart_index
+            charts = _chart_slots(dataset.charts, chart_index)
+        
+            # Store chart metadata
+            # Preserve existing notes if updating other fields
+            existing_notes = ""
+            if charts[chart_index] is not None:
+                existing_notes = charts[chart_index].get("notes", "")
+        
+            charts[chart_index] = {
+                "chart_spec": chart_spec,
+                "plan": plan,
+                "figure": figure_data,
+                "chart_type": chart_type,
+                "title": title,
+                "notes": existing_notes,
+                "created_at": utcnow_iso()
+            }
     
     def update_chart_notes(
         self,
@@ -243,25 +746,20 @@ class DatasetService:
             chart_index: Chart index
             notes: Notes content (markdown string)
         """
-        if user_id not in self._store:
-            self._store[user_id] = {}
-        
-        if dataset_id not in self._store[user_id]:
-            raise ValueError(f"Dataset {dataset_id} not found. Upload dataset first.")
+        with self._user_locks[user_id]:
+            dataset = self._entry(user_id, dataset_id)
+            if not dataset:
+                raise ValueError(f"Dataset {dataset_id} not found. Upload dataset first.")
         
-        dataset = self._store[user_id][dataset_id]
+            charts = _chart_slots(dataset.charts, chart_index)
         
-        # Initialize charts metadata if first time
-        if "charts" not in dataset:
-            dataset["charts"] = {}
+            # Initialize chart if doesn't exist
+            if charts[chart_index] is None:
+                charts[chart_index] = {}
         
-        # Initialize chart if doesn't exist
-        if chart_index not in dataset["charts"]:
-            dataset["charts"][chart_index] = {}
-        
-        # Update notes
-        dataset["charts"][chart_index]["notes"] = notes
-        dataset["charts"][chart_index]["notes_updated_at"] = datetime.utcnow().isoformat()
+            # Update notes
+            charts[chart_index]["notes"] = notes
+            charts[chart_index]["notes_updated_at"] = utcnow_iso()
     
     def get_chart_metadata(
         self,
@@ -275,9 +773,10 @@ class DatasetService:
         Returns:
             Dict with chart metadata or None if not found
         """
-        if user_id in self._store and dataset_id in self._store[user_id]:
-            charts = self._store[user_id][dataset_id].get("charts", {})
-            return charts.get(chart_index)
+        entry = self._entry(user_id, dataset_id)
+        if entry:
+            charts = entry.charts
+            return charts[chart_index] if 0 <= chart_index < len(charts) else None
         return None
     
     def delete_chart_metadata(
@@ -297,17 +796,19 @@ class DatasetService:
         Returns:
             True if chart was deleted, False if not found
         """
-        if user_id in self._store and dataset_id in self._store[user_id]:
-            charts = self._store[user_id][dataset_id].get("charts", {})
-            if chart_index in charts:
-                del charts[chart_index]
-                # Re-index remaining charts to maintain sequential order
-                new_charts = {}
-                for i, (idx, chart_data) in enumerate(sorted(charts.items())):
-                    new_charts[i] = {**chart_data, "chart_index": i}
-                self._store[user_id][dataset_id]["charts"] = new_charts
-                return True
-        return False
+        with self._user_locks[user_id]:
+            entry = self._entry(user_id, dataset_id)
+            if entry:
+                charts = entry.charts
+                if 0 <= chart_index < len(charts) and charts[chart_index] is not None:
+                    charts.pop(chart_index)
+                    # Close any remaining gaps and re-index, so indices stay sequential
+                    charts[:] = [
+                        {**chart_data, "chart_index": i}
+                        for i, chart_data in enumerate(c for c in charts if c is not None)
+                    ]
+                    return True
+            return False
     
     def get_chart_plan(
         self,
@@ -334,25 +835,64 @@ class DatasetService:
         if user_id not in self._store or not self._store[user_id]:
             return None
         
-        # Find the most recent dataset
-        latest = max(
-            self._store[user_id].items(),
-            key=lambda x: x[1]["uploaded_at"]
-        )
+        latest_id = self._latest.get(user_id)
+        if latest_id is None:
+            # Pointer was cleared by a delete - rescan once
+            latest_id = max(
+                self._store[user_id].items(),
+                key=lambda x: (x[1].upload_seq, x[1].uploaded_at)
+            )[0]
+            self._latest[user_id] = latest_id
         
-        return (latest[0], latest[1]["df"])  # (dataset_id, DataFrame)
+        return (latest_id, self.get_dataset(user_id, latest_id))  # (dataset_id, DataFrame)
+    
+    async def get_latest_dataset_async(self, user_id: int) -> Optional[Tuple[str, pd.DataFrame]]:
+        """get_latest_dataset for async callers (see get_dataset_async)."""
+        return await asyncio.to_thread(self.get_latest_dataset, user_id)
+    
+    def get_sample_markdown(
+        self,
+        user_id: int,
+        dataset_id: str,
+        sheet_name: Optional[str] = None,
+        rows: int = 5
+    ) -> Optional[str]:
+        """
+        Markdown table of the first rows of a sheet (default: the first sheet).
+        Cached on the entry since to_markdown (tabulate) is slow on wide frames.
+        Returns None if the dataset isn't loaded.
+        """
+        entry = self._entry(user_id, dataset_id)
+        if entry is None:
+            return None
+        
+        key = (sheet_name or entry.sheet_names[0], rows)
+        markdown = entry.sample_markdown.get(key)
+        if markdown is None:
+            data = self.get_dataset(user_id, dataset_id)
+            markdown = data[key[0]].head(rows).to_markdown()
+            entry.sample_markdown[key] = markdown
+        return markdown
+    
+    async def get_sample_markdown_async(
+        self,
+        user_id: int,
+        dataset_id: str,
+        sheet_name: Optional[str] = None,
+        rows: int = 5
+    ) -> Optional[str]:
+        """get_sample_markdown for async callers (see get_dataset_async)."""
+        return await asyncio.to_thread(self.get_sample_markdown, user_id, dataset_id, sheet_name, rows)
     
     def get_context(self, user_id: int, dataset_id: str) -> Optional[str]:
         """Get the generated context for a dataset from memory"""
-        if user_id in self._store and dataset_id in self._store[user_id]:
-            return self._store[user_id][dataset_id].get("context")
-        return None
+        entry = self._entry(user_id, dataset_id)
+        return entry.context if entry else None
     
     def get_context_status(self, user_id: int, dataset_id: str) -> str:
         """Get the context generation status for a dataset"""
-        if user_id in self._store and dataset_id in self._store[user_id]:
-            return self._store[user_id][dataset_id].get("context_status", "pending")
-        return "not_found"
+        entry = self._entry(user_id, dataset_id)
+        return entry.context_status if entry else "not_found"
     
     # ==================== Context Generation Methods ====================
     
@@ -364,154 +904,388 @@ class DatasetService:
     ) -> str:
         """
         Generate context asynchronously and update database and memory.
+        Requests arriving within the same batching window share one batched DSPy call.
         Returns the generated context string.
         """
-        # Run in thread pool to not block async loop
-        loop = asyncio.get_event_loop()
-        context = await loop.run_in_executor(
-            None, 
-            self._generate_context_sync, 
-            dataset_id, 
-            df,
-            user_id
-        )
+        loop = asyncio.get_running_loop()
+        
+        # Lazily create the queue/worker on the running loop
+        if self._ctx_worker is None or self._ctx_worker.done():
+            self._pending_ctx = asyncio.Queue()
+            self._ctx_worker = loop.create_task(self._context_batch_worker())
         
-        return context
+        future = loop.create_future()
+        await self._pending_ctx.put((dataset_id, df, user_id, future))
+        return await future
     
-    def _generate_context_sync(
+    async def _context_batch_worker(self) -> None:
+        """Collect queued context jobs into batches and dispatch them to the executor."""
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            jobs = [await self._pending_ctx.get()]
+            
+            # Keep collecting until the batch is full or the window closes
+            deadline = loop.time() + CONTEXT_BATCH_WINDOW_SECONDS
+            while len(jobs) < CONTEXT_BATCH_SIZE:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    jobs.append(await asyncio.wait_for(self._pending_ctx.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Don't await the batch so the next window can start collecting
+            task = loop.create_task(self._run_context_batch(jobs))
+            self._ctx_batches.add(task)
+            task.add_done_callback(self._ctx_batches.discard)
+    
+    async def _run_context_batch(self, jobs: List[tuple]) -> None:
+        """Run one batch of context jobs in the thread pool and resolve their futures."""
+        loop = asyncio.get_running_loop()
+        requests = [(dataset_id, df, user_id) for dataset_id, df, user_id, _ in jobs]
+        
+        try:
+            if len(requests) == 1:
+                # Single job: plain per-request path
+                try:
+                    outcomes = [await self._generate_context_single(*requests[0])]
+                except Exception as e:
+                    outcomes = [e]
+            else:
+                outcomes = await loop.run_in_executor(
+                    _CTX_EXECUTOR,
+                    self._generate_contexts_batch_sync,
+                    requests
+                )
+        except Exception as e:
+            outcomes = [e] * len(jobs)
+        
+        for (_, _, _, future), outcome in zip(jobs, outcomes):
+            if future.done():
+                continue
+            if isinstance(outcome, Exception):
+                future.set_exception(outcome)
+            else:
+                future.set_result(outcome)
+    
+    async def _generate_context_single(
         self, 
         dataset_id: str, 
         df: pd.DataFrame | Dict[str, pd.DataFrame],
         user_id: Optional[int] = None
     ) -> str:
-        """Synchronous context generation using DSPy. Handles both single DataFrames and multi-sheet Excel."""
-        
-        # Helper function to convert pandas/numpy objects to JSON-serializable types
-        def make_json_serializable(obj):
-            """Convert pandas/numpy objects to JSON-serializable types"""
-            if isinstance(obj, (pd.Timestamp, datetime)):
-                return obj.isoformat()
-            elif isinstance(obj, (np.integer, np.floating)):
-                return float(obj)
-            elif pd.isna(obj):
-                return None
-            elif isinstance(obj, dict):
-                return {k: make_json_serializable(v) for k, v in obj.items()}
-            elif isinstance(obj, list):
-                return [make_json_serializable(item) for item in obj]
-            return obj
+        """
+        Per-request context generation. Handles both single DataFrames and multi-sheet Excel.
+        Prompt building and DB writes run in the context thread pool; the DSPy LM call
+        itself is awaited on the event loop, so no thread is held during the HTTP request.
+        """
+        loop = asyncio.get_running_loop()
+        dataframe_info, sheets_info, fingerprint, generated_context = await loop.run_in_executor(
+            _CTX_EXECUTOR,
+            self._prepare_context_job,
+            dataset_id,
+            df,
+            user_id
+        )
         
+        if generated_context is None:
+            try:
+                # Generate context using DSPy (native async LiteLLM completion)
+                with dspy.context(lm = dspy.LM('openai/gpt-4o-mini', max_tokens =2500)):
+                    result = await self.context_creator.acall(
+                        dataframe_info=dataframe_info
+                    )
+                generated_context = result.dataset_context
+            except Exception:
+                await loop.run_in_executor(_CTX_EXECUTOR, self._persist_context_result, dataset_id, user_id, None, None)
+                raise
+            self._cache_context(fingerprint, generated_context)
+        
+        await loop.run_in_executor(
+            _CTX_EXECUTOR,
+            self._persist_context_result,
+            dataset_id,
+            user_id,
+            generated_context,
+            sheets_info
+        )
+        return generated_context
+    
+    def _prepare_context_job(
+        self,
+        dataset_id: str,
+        df: pd.DataFrame | Dict[str, pd.DataFrame],
+        user_id: Optional[int]
+    ) -> Tuple[str, dict, Optional[bytes], Optional[str]]:
+        """
+        Mark a dataset as 'generating' and build its prompt.
+        Returns (dataframe_info, sheets_info, fingerprint, cached context or None).
+        """
+        try:
+            # 'generating' is tracked in memory only; the database gets the terminal status in one commit
+            self._set_memory_context_status(user_id, dataset_id, "generating")
+            
+            dataframe_info, sheets_info, fingerprint = self._get_context_prompt(user_id, dataset_id, df)
+            return dataframe_info, sheets_info, fingerprint, self._get_cached_context(fingerprint)
+        except Exception:
+            self._persist_context_result(dataset_id, user_id, None, None)
+            raise
+    
+    def _generate_contexts_batch_sync(
+        self,
+        requests: List[Tuple[str, pd.DataFrame | Dict[str, pd.DataFrame], Optional[int]]]
+    ) -> List[str | Exception]:
+        """
+        Generate contexts for several datasets with a single batched DSPy call.
+        Uses one DB session and one commit for the whole batch.
+        Returns one entry per request: the generated context, or the exception that failed it.
+        """
         db = SessionLocal()
+        outcomes: List[str | Exception] = [None] * len(requests)
+        results = []  # (dataset_id, user_id, context or None, sheets_info) for the final commit
+        prepared = []  # (position, dataset_id, user_id, sheets_info, dataframe_info, fingerprint)
         
         try:
-            # Update database status to 'generating'
-            dataset = db.query(Dataset).filter(Dataset.dataset_id == dataset_id).first()
-            if dataset:
-                dataset.context_status = "generating"
-                db.commit()
-                user_id = user_id or dataset.user_id
+            for position, (dataset_id, df, user_id) in enumerate(requests):
+                self._set_memory_context_status(user_id, dataset_id, "generating")
+                try:
+                    dataframe_info, sheets_info, fingerprint = self._get_context_prompt(user_id, dataset_id, df)
+                    cached_context = self._get_cached_context(fingerprint)
+                    if cached_context is not None:
+                        results.append((dataset_id, user_id, cached_context, sheets_info))
+                        outcomes[position] = cached_context
+                    else:
+                        prepared.append((position, dataset_id, user_id, sheets_info, dataframe_info, fingerprint))
+                except Exception as e:
+                    results.append((dataset_id, user_id, None, None))
+                    outcomes[position] = e
             
-            # Update in-memory status
-            if user_id and user_id in self._store and dataset_id in self._store[user_id]:
-                self._store[user_id][dataset_id]["context_status"] = "generating"
-            
-            # Normalize df to dict format if it's a plain DataFrame
-            if isinstance(df, dict):
-                # Already a dict, use as-is
-                df_dict = df
-            else:
-                # Plain DataFrame - wrap it in a dict
-                # Use a generic name since we don't have the filename here
-                df_dict = {"data": df}
-            
-            # Data is always a dict now (normalized above)
-            # Prepare dataframe info for all sheets
-            sheet_names_list = list(df_dict.keys())
-            is_multisheet = len(sheet_names_list) > 1
-            
-            sheets_info = {}
-            for sheet_name, sheet_df in df_dict.items():
-                # Convert sample values to JSON-serializable format
-                sample_records = sheet_df.head(2).to_dict('records')
-                sample_records_clean = [
-                    {k: make_json_serializable(v) for k, v in record.items()}
-                    for record in sample_records
+            if prepared:
+                examples = [
+                    dspy.Example(dataframe_info=item[4]).with_inputs("dataframe_info")
+                    for item in prepared
                 ]
+                with dspy.context(lm = dspy.LM('openai/gpt-4o-mini', max_tokens =2500)):
+                    predictions = self.context_creator.batch(
+                        examples,
+                        num_threads=len(examples),
+                        max_errors=len(examples),
+                        disable_progress_bar=True
+                    )
                 
-                # Convert statistics to JSON-serializable format
-                stats = sheet_df.describe().to_dict() if len(sheet_df) > 0 else {}
-                stats_clean = {k: make_json_serializable(v) for k, v in stats.items()}
-                
-                sheets_info[sheet_name] = {
-                    "columns": sheet_df.columns.tolist(),
-                    "dtypes": sheet_df.dtypes.astype(str).to_dict(),
-                    "shape": sheet_df.shape,
-                    "sample_values": sample_records_clean,
-                    "statistics": stats_clean
-                }
-            
-            # Create DSPy input with available sheet names
-            context_info = {
-                "available_sheets": sheet_names_list,
-                "is_multisheet": is_multisheet,
-                "sheets": {
-                    name: {
-                        "columns": info["columns"],
-                        "shape": info["shape"],
-                        "sample": df_dict[name].head(2).to_markdown()
-                    }
-                    for name, info in sheets_info.items()
-                }
-            }
-
-            # Add execution environment info to context
-            sheet_names_str = ", ".join(sheet_names_list)
-            sheet_names_quoted = ", ".join([f"'{name}'" for name in sheet_names_list])
-            execution_info = (
-                "\n\nIMPORTANT - Available DataFrames in execution environment:\n"
-                f"- Available sheets: {sheet_names_str}\n"
-                f"- Default DataFrame: 'df' (contains: {sheet_names_list[0]})\n"
-                f"- Access specific sheets by name: {sheet_names_quoted}\n"
-            )
-            # Generate context using DSPy
-            with dspy.context(lm = dspy.LM('openai/gpt-4o-mini', max_tokens =2500)):
-                result = self.context_creator(
-                    dataframe_info=str(context_info) + execution_info
-                )
-            
-            generated_context = result.dataset_context
-            
-            # Update database with generated context
-            if dataset:
-                dataset.context = generated_context
-                dataset.context_generated_at = datetime.utcnow()
-                dataset.context_status = "completed"
-                dataset.columns_info = sheets_info
-                db.commit()
-            
-            # Update in-memory context
-            if user_id and user_id in self._store and dataset_id in self._store[user_id]:
-                self._store[user_id][dataset_id]["context"] = generated_context
-                self._store[user_id][dataset_id]["context_status"] = "completed"
-                
-            return generated_context
+                for (position, dataset_id, user_id, sheets_info, _, fingerprint), prediction in zip(prepared, predictions):
+                    if prediction is None:
+                        results.append((dataset_id, user_id, None, None))
+                        outcomes[position] = RuntimeError(f"Context generation failed for dataset {dataset_id}")
+                    else:
+                        self._cache_context(fingerprint, prediction.dataset_context)
+                        results.append((dataset_id, user_id, prediction.dataset_context, sheets_info))
+                        outcomes[position] = prediction.dataset_context
             
+            self._save_context_results(db, results)
+            return outcomes
         except Exception as e:
-            # Mark as failed in database
-            if dataset:
-                dataset.context_status = "failed"
-                db.commit()
-            
-            # Mark as failed in memory
-            if user_id and user_id in self._store and dataset_id in self._store[user_id]:
-                self._store[user_id][dataset_id]["context_status"] = "failed"
-            
-            raise e
+            db.rollback()
+            self._save_context_results(db, [(dataset_id, user_id, None, None) for dataset_id, _, user_id in requests])
+            return [e] * len(requests)
+        finally:
+            db.close()
+    
+    def _persist_context_result(
+        self,
+        dataset_id: str,
+        user_id: Optional[int],
+        generated_context: Optional[str],
+        sheets_info: Optional[dict]
+    ) -> None:
+        """Persist a single context result in its own session; a None context marks it as failed."""
+        db = SessionLocal()
+        try:
+            self._save_context_results(db, [(dataset_id, user_id, generated_context, sheets_info)])
         finally:
             db.close()
     
+    def _get_cached_context(self, fingerprint: Optional[bytes]) -> Optional[str]:
+        """Return a previously generated context for an identical schema/sample, if any."""
+        if fingerprint is None:
+            return None
+        with self._ctx_cache_lock:
+            context = self._ctx_cache.get(fingerprint)
+            if context is not None:
+                self._ctx_cache.move_to_end(fingerprint)
+            return context
+    
+    def _cache_context(self, fingerprint: Optional[bytes], context: str) -> None:
+        """Remember a generated context, evicting the least recently used beyond CONTEXT_CACHE_SIZE."""
+        if fingerprint is None or not context:
+            return
+        with self._ctx_cache_lock:
+            self._ctx_cache[fingerprint] = context
+            self._ctx_cache.move_to_end(fingerprint)
+            while len(self._ctx_cache) > CONTEXT_CACHE_SIZE:
+                self._ctx_cache.popitem(last=False)
+    
+    def _set_memory_context_status(self, user_id: Optional[int], dataset_id: str, status: str) -> None:
+        """Update the in-memory context status of a dataset, if loaded."""
+        if user_id:
+            with self._user_locks[user_id]:
+                entry = self._entry(user_id, dataset_id)
+                if entry:
+                    entry.context_status = status
+            self._share_entry(user_id, dataset_id)
+    
+    def _save_context_results(
+        self,
+        db: Session,
+        results: List[Tuple[str, Optional[int], Optional[str], Optional[dict]]]
+    ) -> None:
+        """
+        Persist terminal context results to database and memory.
+        Each result is (dataset_id, user_id, context, sheets_info); a None context marks it as failed.
+        All rows are loaded with one query and written with one commit.
+        """
+        if not results:
+            return
+        
+        datasets = {
+            dataset.dataset_id: dataset
+            for dataset in db.query(Dataset).filter(
+                Dataset.dataset_id.in_([dataset_id for dataset_id, _, _, _ in results])
+            ).all()
+        }
+        
+        # Update database
+        generated_at = utcnow()
+        for dataset_id, _, generated_context, sheets_info in results:
+            dataset = datasets.get(dataset_id)
+            if not dataset:
+                continue
+            if generated_context is None:
+                dataset.context_status = "failed"
+            else:
+                dataset.context = generated_context
+                dataset.context_generated_at = generated_at
+                dataset.context_status = "completed"
+                dataset.columns_info = sheets_info
+        db.commit()
+        
+        # Update in-memory context
+        for dataset_id, user_id, generated_context, _ in results:
+            dataset = datasets.get(dataset_id)
+            user_id = user_id or (dataset.user_id if dataset else None)
+            if not user_id:
+                continue
+            with self._user_locks[user_id]:
+                entry = self._entry(user_id, dataset_id)
+                if entry is None:
+                    continue
+                if generated_context is None:
+                    entry.context_status = "failed"
+                else:
+                    entry.context = generated_context
+                    entry.context_status = "completed"
+            self._share_entry(user_id, dataset_id)
+    
+    def _get_context_prompt(
+        self,
+        user_id: Optional[int],
+        dataset_id: str,
+        df: pd.DataFrame | Dict[str, pd.DataFrame]
+    ) -> Tuple[str, dict, Optional[bytes]]:
+        """
+        Return (dataframe_info, sheets_info, fingerprint) for a dataset, reusing the prompt
+        cached on its entry when the data is unchanged, so retries and regenerations skip
+        describe() and the markdown samples.
+        """
+        fingerprint = context_fingerprint(df, user_id)
+        entry = self._entry(user_id, dataset_id) if user_id else None
+        if entry is not None and fingerprint is not None:
+            cached = entry.prompt_cache
+            if cached is not None and cached[0] == fingerprint:
+                return cached[1], cached[2], fingerprint
+        
+        dataframe_info, sheets_info = self._build_context_prompt(df)
+        if entry is not None and fingerprint is not None:
+            entry.prompt_cache = (fingerprint, dataframe_info, sheets_info)
+        return dataframe_info, sheets_info, fingerprint
+    
+    def _build_context_prompt(
+        self,
+        df: pd.DataFrame | Dict[str, pd.DataFrame]
+    ) -> Tuple[str, dict]:
+        """
+        Build the DSPy prompt for a dataset.
+        Returns (dataframe_info prompt string, per-sheet info stored as columns_info).
+        """
+        # Normalize df to dict format if it's a plain DataFrame
+        if isinstance(df, dict):
+            # Already a dict, use as-is
+            df_dict = df
+        else:
+            # Plain DataFrame - wrap it in a dict
+            # Use a generic name since we don't have the filename here
+            df_dict = {"data": df}
+        
+        # Data is always a dict now (normalized above)
+        # Prepare dataframe info for all sheets
+        sheet_names_list = list(df_dict.keys())
+        is_multisheet = len(sheet_names_list) > 1
+        
+        # One pass per sheet builds both the stored info and the prompt; sheets of a
+        # workbook are independent, so they are built in parallel (describe() releases the GIL)
+        if is_multisheet:
+            built = list(_SHEET_EXECUTOR.map(_build_sheet_info, df_dict.values()))
+        else:
+            built = [_build_sheet_info(df_dict[sheet_names_list[0]])]
+        sheets_info = {name: info for name, (info, _) in zip(sheet_names_list, built)}
+        sheets_prompt = {name: prompt for name, (_, prompt) in zip(sheet_names_list, built)}
+        
+        # Create DSPy input with available sheet names
+        context_info = {
+            "available_sheets": sheet_names_list,
+            "is_multisheet": is_multisheet,
+            "sheets": sheets_prompt
+        }
+
+        # Add execution environment info to context
+        sheet_names_str = ", ".join(sheet_names_list)
+        sheet_names_quoted = ", ".join([f"'{name}'" for name in sheet_names_list])
+        execution_info = (
+            "\n\nIMPORTANT - Available DataFrames in execution environment:\n"
+            f"- Available sheets: {sheet_names_str}\n"
+            f"- Default DataFrame: 'df' (contains: {sheet_names_list[0]})\n"
+            f"- Access specific sheets by name: {sheet_names_quoted}\n"
+        )
+        
+        # Minified JSON is more compact (fewer prompt tokens) than the Python dict repr
+        return json.dumps(context_info, separators=(",", ":"), default=str) + execution_info, sheets_info
+    
     # ==================== Dashboard Query Persistence ====================
     
+    def _dataset_pk(self, db: Session, user_id: int, dataset_id: str) -> Optional[int]:
+        """
+        Resolve a dataset_id string to the Dataset primary key, or None if the user has no such dataset.
+        Cached on the in-memory entry so repeated saves skip the lookup query.
+        """
+        entry = self._entry(user_id, dataset_id)
+        if entry is not None and entry.db_pk is not None:
+            return entry.db_pk
+        
+        row = db.query(Dataset.id).filter(
+            and_(
+                Dataset.user_id == user_id,
+                Dataset.dataset_id == dataset_id
+            )
+        ).first()
+        if row is None:
+            return None
+        
+        if entry is not None:
+            entry.db_pk = row.id
+        return row.id
+    
     def save_dashboard_query(
         self,
         db: Session,
@@ -538,19 +1312,14 @@ class DatasetService:
             background_color: Optional dashboard background color (hex code)
             text_color: Optional dashboard text color (hex code)
         """
-        # Find dataset by dataset_id string
-        dataset = db.query(Dataset).filter(
-            and_(
-                Dataset.user_id == user_id,
-                Dataset.dataset_id == dataset_id
-            )
-        ).first()
+        # Resolve dataset_id string to the Dataset primary key
+        dataset_pk = self._dataset_pk(db, user_id, dataset_id)
         
-        if not dataset:
+        if dataset_pk is None:
             raise ValueError(f"Dataset {dataset_id} not found")
         
         dashboard_query = DashboardQuery(
-            dataset_id=dataset.id,
+            dataset_id=dataset_pk,
             user_id=user_id,
             query=query,
             query_type=query_type,
@@ -573,18 +1342,22 @@ class DatasetService:
         dataset_id: str
     ) -> List[Dict[str, Any]]:
         """Get all dashboard queries for a dataset."""
-        dataset = db.query(Dataset).filter(
+        # One round-trip: the dataset is resolved through a join, and only the
+        # needed columns are loaded (no ORM objects)
+        queries = db.query(
+            DashboardQuery.id,
+            DashboardQuery.query,
+            DashboardQuery.query_type,
+            DashboardQuery.dashboard_title,
+            DashboardQuery.charts_data,
+            DashboardQuery.background_color,
+            DashboardQuery.text_color,
+            DashboardQuery.created_at
+        ).join(Dataset, DashboardQuery.dataset_id == Dataset.id).filter(
             and_(
                 Dataset.user_id == user_id,
                 Dataset.dataset_id == dataset_id
             )
-        ).first()
-        
-        if not dataset:
-            return []
-        
-        queries = db.query(DashboardQuery).filter(
-            DashboardQuery.dataset_id == dataset.id
         ).order_by(DashboardQuery.created_at).all()
         
         return [
@@ -699,19 +1472,14 @@ class DatasetService:
         Returns:
             Updated DashboardQuery or None if not found
         """
-        dataset = db.query(Dataset).filter(
-            and_(
-                Dataset.user_id == user_id,
-                Dataset.dataset_id == dataset_id
-            )
-        ).first()
+        dataset_pk = self._dataset_pk(db, user_id, dataset_id)
         
-        if not dataset:
+        if dataset_pk is None:
             return None
         
         # Get the latest dashboard query
         latest_query = db.query(DashboardQuery).filter(
-            DashboardQuery.dataset_id == dataset.id
+            DashboardQuery.dataset_id == dataset_pk
         ).order_by(DashboardQuery.created_at.desc()).first()
         
         if latest_query:
@@ -749,18 +1517,13 @@ class DatasetService:
             code: Executable code if applicable
             chart_index: Chart index if related to a chart
         """
-        dataset = db.query(Dataset).filter(
-            and_(
-                Dataset.user_id == user_id,
-                Dataset.dataset_id == dataset_id
-            )
-        ).first()
+        dataset_pk = self._dataset_pk(db, user_id, dataset_id)
         
-        if not dataset:
+        if dataset_pk is None:
             raise ValueError(f"Dataset {dataset_id} not found")
         
         chat_message = ChatMessage(
-            dataset_id=dataset.id,
+            dataset_id=dataset_pk,
             user_id=user_id,
             role=role,
             content=content,
@@ -782,18 +1545,21 @@ class DatasetService:
         dataset_id: str
     ) -> List[Dict[str, Any]]:
         """Get chat history for a dataset."""
-        dataset = db.query(Dataset).filter(
+        # One round-trip: the dataset is resolved through a join, and only the
+        # needed columns are loaded (no ORM objects)
+        messages = db.query(
+            ChatMessage.id,
+            ChatMessage.role,
+            ChatMessage.content,
+            ChatMessage.query_type,
+            ChatMessage.code,
+            ChatMessage.chart_index,
+            ChatMessage.created_at
+        ).join(Dataset, ChatMessage.dataset_id == Dataset.id).filter(
             and_(
                 Dataset.user_id == user_id,
                 Dataset.dataset_id == dataset_id
             )
-        ).first()
-        
-        if not dataset:
-            return []
-        
-        messages = db.query(ChatMessage).filter(
-            ChatMessage.dataset_id == dataset.id
         ).order_by(ChatMessage.created_at).all()
         
         return [
@@ -842,23 +1608,23 @@ class DatasetService:
             hours_valid: Hours until expiry (None for no expiry)
             background_color: Dashboard background color (hex code)
         """
-        dataset = db.query(Dataset).filter(
-            and_(
-                Dataset.user_id == user_id,
-                Dataset.dataset_id == dataset_id
-            )
-        ).first()
+        dataset_pk = self._dataset_pk(db, user_id, dataset_id)
         
-        if not dataset:
+        if dataset_pk is None:
             raise ValueError(f"Dataset {dataset_id} not found")
         
+        # Normalize notes once here instead of on every public read
+        for fig_data in figures_data:
+            if isinstance(fig_data, dict):
+                fig_data.setdefault("notes", "")
+        
         # Generate unique token
         share_token = secrets.token_urlsafe(32)
         
         # Always create a new public dashboard entry with latest data
         # This ensures each publish creates a new unique link
         public_dashboard = PublicDashboard(
-            dataset_id=dataset.id,
+            dataset_id=dataset_pk,
             user_id=user_id,
             share_token=share_token,
             figures_data=figures_data,
@@ -873,39 +1639,74 @@ class DatasetService:
             chart_opacities=chart_opacities or {},
             apply_to_containers=apply_to_containers,
             is_public=True,
-            expires_at=datetime.utcnow() + timedelta(hours=hours_valid) if hours_valid else None
+            expires_at=utcnow() + timedelta(hours=hours_valid) if hours_valid else None
         )
         db.add(public_dashboard)
         db.commit()
         db.refresh(public_dashboard)
         return public_dashboard
     
-    def get_public_dashboard(
+    def get_public_dashboard_json(
         self,
         db: Session,
         token: str
-    ) -> Optional[Dict[str, Any]]:
+    ) -> Optional[Any]:
         """
-        Get public dashboard by token.
-        Returns None if not found, expired, or not public.
+        Get the public dashboard response as pre-serialized JSON bytes.
+        
+        Shared dashboards are never modified after creation, so the
+        serialized body is cached per token for PUBLIC_DASHBOARD_CACHE_TTL
+        seconds. Link expiry is still checked on every call.
+        
+        Returns:
+            JSON bytes, None if not found or not public, or {"error": "expired"}
         """
+        with self._public_cache_lock:
+            cached = self._public_cache.get(token)
+            if cached is not None and cached[2] <= time.monotonic():
+                del self._public_cache[token]
+                cached = None
+        
+        if cached is not None:
+            body, expires_at, _ = cached
+            if expires_at and utcnow() > expires_at:
+                return {"error": "expired"}
+            return body
+        
         public_dashboard = db.query(PublicDashboard).filter(
             PublicDashboard.share_token == token
         ).first()
         
-        if not public_dashboard:
+        if not public_dashboard or not public_dashboard.is_public:
             return None
         
-        if not public_dashboard.is_public:
-            return None
-        
-        if public_dashboard.expires_at and datetime.utcnow() > public_dashboard.expires_at:
+        if public_dashboard.expires_at and utcnow() > public_dashboard.expires_at:
             return {"error": "expired"}
         
-        # Ensure figures_data includes notes if they exist
+        body = json.dumps(
+            self._public_dashboard_payload(public_dashboard),
+            ensure_ascii=False,
+            allow_nan=False,
+            separators=(",", ":"),
+        ).encode("utf-8")
+        
+        with self._public_cache_lock:
+            self._public_cache[token] = (
+                body,
+                public_dashboard.expires_at,
+                time.monotonic() + PUBLIC_DASHBOARD_CACHE_TTL,
+            )
+            self._public_cache.move_to_end(token)
+            while len(self._public_cache) > PUBLIC_DASHBOARD_CACHE_SIZE:
+                self._public_cache.popitem(last=False)
+        return body
+    
+    @staticmethod
+    def _public_dashboard_payload(public_dashboard: PublicDashboard) -> Dict[str, Any]:
+        """Build the response dict for a public dashboard row."""
+        # Dashboards shared before notes were normalized at creation may lack them
         figures_data = public_dashboard.figures_data or []
         for fig_data in figures_data:
-            # Notes should already be in figures_data from share request, but ensure it's present
             if "notes" not in fig_data:
                 fig_data["notes"] = ""
         
@@ -4,17 +4,108 @@ Subscription plan service for managing pricing tiers
 from sqlalchemy.orm import Session
 from typing import Optional, List, Dict, Any
 from decimal import Decimal
+import copy
 import logging
 import os
+import threading
+import time
 
 from ..models import SubscriptionPlan
 
 logger = logging.getLogger(__name__)
 
+# Plans change rarely, so Stripe price ID -> plan ID lookups are cached briefly
+PLAN_CACHE_TTL_SECONDS = float(os.getenv("PLAN_CACHE_TTL_SECONDS", "300"))
+PLAN_CACHE_MAX_ENTRIES = 128
+
+# Columns update_plan is allowed to set
+_MUTABLE_PLAN_COLS = frozenset(c.name for c in SubscriptionPlan.__table__.columns) - {"id", "created_at"}
+
+# Default plan configurations, read from the environment once at import
+_DEFAULT_PLANS = [
+    {
+        "name": "Free",
+        "price_monthly": Decimal("0.00"),
+        "price_yearly": Decimal("0.00"),
+        "credits_per_month": 25,
+        "credits_per_analyze": 5,
+        "credits_per_edit": 2,
+        "stripe_price_id": os.getenv("STRIPE_FREE_PRICE_MONTHLY_ID"),  # Legacy support
+        "stripe_price_id_monthly": os.getenv("STRIPE_FREE_PRICE_MONTHLY_ID"),
+        "stripe_price_id_yearly": os.getenv("STRIPE_FREE_PRICE_YEARLY_ID"),
+        "stripe_product_id": os.getenv("STRIPE_FREE_PRODUCT_ID"),
+        "features": {
+            "max_datasets": 3,
+            "max_file_size_mb": 10,
+            "export_formats": ["png", "csv"]
+        },
+        "sort_order": 0
+    },
+    {
+        "name": "Pro",
+        "price_monthly": Decimal("20.00"),
+        "price_yearly": Decimal("192.00"),  # $20 * 12 * 0.8 (20% discount)
+        "credits_per_month": 500,
+        "credits_per_analyze": 5,
+        "credits_per_edit": 2,
+        "stripe_price_id": os.getenv("STRIPE_PRO_PRICE_MONTHLY_ID"),  # Legacy support
+        "stripe_price_id_monthly": os.getenv("STRIPE_PRO_PRICE_MONTHLY_ID"),
+        "stripe_price_id_yearly": os.getenv("STRIPE_PRO_PRICE_YEARLY_ID"),
+        "stripe_product_id": os.getenv("STRIPE_PRO_PRODUCT_ID"),
+        "features": {
+            "max_datasets": 50,
+            "max_file_size_mb": 100,
+            "export_formats": ["png", "csv", "pdf", "xlsx"],
+            "priority_support": True
+        },
+        "sort_order": 1
+    },
+    {
+        "name": "Ultra",
+        "price_monthly": Decimal("30"),
+        "price_yearly": Decimal("288"),  # $29.99 * 12 * 0.8 (20% discount)
+        "credits_per_month": 1000,
+        "credits_per_analyze": 5,
+        "credits_per_edit": 2,
+        "stripe_price_id": os.getenv("STRIPE_ULTRA_PRICE_MONTHLY_ID"),  # Legacy support
+        "stripe_price_id_monthly": os.getenv("STRIPE_ULTRA_PRICE_MONTHLY_ID"),
+        "stripe_price_id_yearly": os.getenv("STRIPE_ULTRA_PRICE_YEARLY_ID"),
+        "stripe_product_id": os.getenv("STRIPE_ULTRA_PRODUCT_ID"),
+        "features": {
+            "max_datasets": -1,  # Unlimited
+            "max_file_size_mb": 500,
+            "export_formats": ["png", "csv", "pdf", "xlsx", "json"],
+            "priority_support": True,
+            "custom_branding": True,
+            "api_access": True
+        },
+        "sort_order": 2
+    }
+]
+
 
 class PlanService:
     """Service for managing subscription plans"""
     
+    def __init__(self):
+        # stripe_price_id -> (plan_id, expires_at)
+        self._stripe_price_cache: Dict[str, tuple] = {}
+        # plan name -> (plan_id, expires_at)
+        self._name_cache: Dict[str, tuple] = {}
+        # plan_id -> (info dict, expires_at)
+        self._info_cache: Dict[int, tuple] = {}
+        # (list of info dicts, expires_at) for the active plans
+        self._active_info_cache: Optional[tuple] = None
+        self._cache_lock = threading.Lock()
+    
+    def _invalidate_caches(self) -> None:
+        """Drop cached plan lookups after a plan is created or modified."""
+        with self._cache_lock:
+            self._stripe_price_cache.clear()
+            self._name_cache.clear()
+            self._info_cache.clear()
+            self._active_info_cache = None
+    
     def get_all_active_plans(self, db: Session) -> List[SubscriptionPlan]:
         """
         Get all active subscription plans
@@ -56,7 +147,34 @@ class PlanService:
         Returns:
             SubscriptionPlan object or None if not found
         """
-        return db.query(SubscriptionPlan).filter(SubscriptionPlan.name == name).first()
+        # Name -> id is cached, and the PK lookup is served from the identity map when loaded
+        plan_id = self.get_plan_id_by_name(db, name)
+        if plan_id is None:
+            return None
+        return db.get(SubscriptionPlan, plan_id)
+    
+    def get_plan_id_by_name(self, db: Session, name: str) -> Optional[int]:
+        """
+        Get only the plan ID for a plan name (e.g. the Free plan on signup)
+        
+        Args:
+            db: Database session
+            name: Plan name
+            
+        Returns:
+            Plan ID or None if not found
+        """
+        now = time.monotonic()
+        with self._cache_lock:
+            cached = self._name_cache.get(name)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        
+        plan_id = db.query(SubscriptionPlan.id).filter(SubscriptionPlan.name == name).scalar()
+        if plan_id is not None:
+            with self._cache_lock:
+                self._name_cache[name] = (plan_id, now + PLAN_CACHE_TTL_SECONDS)
+        return plan_id
     
     def get_plan_by_stripe_price_id(self, db: Session, stripe_price_id: str) -> Optional[SubscriptionPlan]:
         """
@@ -69,11 +187,41 @@ class PlanService:
         Returns:
             SubscriptionPlan object or None if not found
         """
-        return db.query(SubscriptionPlan).filter(
+        plan_id = self.get_plan_id_by_stripe_price_id(db, stripe_price_id)
+        if plan_id is None:
+            return None
+        # Primary key lookup, served from the session identity map when possible
+        return db.get(SubscriptionPlan, plan_id)
+    
+    def get_plan_id_by_stripe_price_id(self, db: Session, stripe_price_id: str) -> Optional[int]:
+        """
+        Get only the plan ID for a Stripe price ID (checks legacy, monthly and yearly)
+        
+        Args:
+            db: Database session
+            stripe_price_id: Stripe price ID
+            
+        Returns:
+            Plan ID or None if not found
+        """
+        now = time.monotonic()
+        with self._cache_lock:
+            cached = self._stripe_price_cache.get(stripe_price_id)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        
+        plan_id = db.query(SubscriptionPlan.id).filter(
             (SubscriptionPlan.stripe_price_id == stripe_price_id) |
             (SubscriptionPlan.stripe_price_id_monthly == stripe_price_id) |
             (SubscriptionPlan.stripe_price_id_yearly == stripe_price_id)
-        ).first()
+        ).limit(1).scalar()
+        
+        if plan_id is not None:
+            with self._cache_lock:
+                if len(self._stripe_price_cache) >= PLAN_CACHE_MAX_ENTRIES:
+                    self._stripe_price_cache.clear()
+                self._stripe_price_cache[stripe_price_id] = (plan_id, now + PLAN_CACHE_TTL_SECONDS)
+        return plan_id
     
     def create_plan(
         self,
@@ -89,7 +237,8 @@ class PlanService:
         price_yearly: Optional[Decimal] = None,
         stripe_product_id: Optional[str] = None,
         features: Optional[Dict[str, Any]] = None,
-        sort_order: int = 0
+        sort_order: int = 0,
+        commit: bool = True
     ) -> SubscriptionPlan:
         """
         Create a new subscription plan
@@ -108,6 +257,8 @@ class PlanService:
             stripe_product_id: Stripe product ID
             features: Optional feature dictionary
             sort_order: Display order
+            commit: If False, only add the plan to the session and leave the
+                commit to the caller
             
         Returns:
             Created SubscriptionPlan object
@@ -132,8 +283,10 @@ class PlanService:
             is_active=True
         )
         db.add(plan)
-        db.commit()
-        db.refresh(plan)
+        if commit:
+            db.commit()
+            db.refresh(plan)
+        self._invalidate_caches()
         logger.info(f"Created plan: {name} (${price_monthly}/month, {credits_per_month} credits)")
         return plan
     
@@ -158,12 +311,18 @@ class PlanService:
         if not plan:
             return None
         
+        changed = False
         for key, value in kwargs.items():
-            if hasattr(plan, key):
+            if key in _MUTABLE_PLAN_COLS and getattr(plan, key) != value:
                 setattr(plan, key, value)
+                changed = True
+        
+        if not changed:
+            return plan
         
         db.commit()
         db.refresh(plan)
+        self._invalidate_caches()
         logger.info(f"Updated plan {plan_id}: {plan.name}")
         return plan
     
@@ -182,8 +341,12 @@ class PlanService:
         if not plan:
             return False
         
+        if not plan.is_active:
+            return True
+        
         plan.is_active = False
         db.commit()
+        self._invalidate_caches()
         logger.info(f"Deactivated plan {plan_id}: {plan.name}")
         return True
     
@@ -201,87 +364,46 @@ class PlanService:
         """
         plans = []
         
-        # Default plan configurations
-        default_plans = [
-            {
-                "name": "Free",
-                "price_monthly": Decimal("0.00"),
-                "price_yearly": Decimal("0.00"),
-                "credits_per_month": 25,
-                "credits_per_analyze": 5,
-                "credits_per_edit": 2,
-                "stripe_price_id": os.getenv("STRIPE_FREE_PRICE_MONTHLY_ID"),  # Legacy support
-                "stripe_price_id_monthly": os.getenv("STRIPE_FREE_PRICE_MONTHLY_ID"),
-                "stripe_price_id_yearly": os.getenv("STRIPE_FREE_PRICE_YEARLY_ID"),
-                "stripe_product_id": os.getenv("STRIPE_FREE_PRODUCT_ID"),
-                "features": {
-                    "max_datasets": 3,
-                    "max_file_size_mb": 10,
-                    "export_formats": ["png", "csv"]
-                },
-                "sort_order": 0
-            },
-            {
-                "name": "Pro",
-                "price_monthly": Decimal("20.00"),
-                "price_yearly": Decimal("192.00"),  # $20 * 12 * 0.8 (20% discount)
-                "credits_per_month": 500,
-                "credits_per_analyze": 5,
-                "credits_per_edit": 2,
-                "stripe_price_id": os.getenv("STRIPE_PRO_PRICE_MONTHLY_ID"),  # Legacy support
-                "stripe_price_id_monthly": os.getenv("STRIPE_PRO_PRICE_MONTHLY_ID"),
-                "stripe_price_id_yearly": os.getenv("STRIPE_PRO_PRICE_YEARLY_ID"),
-                "stripe_product_id": os.getenv("STRIPE_PRO_PRODUCT_ID"),
-                "features": {
-                    "max_datasets": 50,
-                    "max_file_size_mb": 100,
-                    "export_formats": ["png", "csv", "pdf", "xlsx"],
-                    "priority_support": True
-                },
-                "sort_order": 1
-            },
-            {
-                "name": "Ultra",
-                "price_monthly": Decimal("30"),
-                "price_yearly": Decimal("288"),  # $29.99 * 12 * 0.8 (20% discount)
-                "credits_per_month": 1000,
-                "credits_per_analyze": 5,
-                "credits_per_edit": 2,
-                "stripe_price_id": os.getenv("STRIPE_ULTRA_PRICE_MONTHLY_ID"),  # Legacy support
-                "stripe_price_id_monthly": os.getenv("STRIPE_ULTRA_PRICE_MONTHLY_ID"),
-                "stripe_price_id_yearly": os.getenv("STRIPE_ULTRA_PRICE_YEARLY_ID"),
-                "stripe_product_id": os.getenv("STRIPE_ULTRA_PRODUCT_ID"),
-                "features": {
-                    "max_datasets": -1,  # Unlimited
-                    "max_file_size_mb": 500,
-                    "export_formats": ["png", "csv", "pdf", "xlsx", "json"],
-                    "priority_support": True,
-                    "custom_branding": True,
-                    "api_access": True
-                },
-                "sort_order": 2
-            }
-        ]
+        # Fetch all existing default plans in one round trip
+        names = [plan_config["name"] for plan_config in _DEFAULT_PLANS]
+        existing_map = {
+            plan.name: plan
+            for plan in db.query(SubscriptionPlan).filter(SubscriptionPlan.name.in_(names)).all()
+        }
         
-        for plan_config in default_plans:
-            existing = self.get_plan_by_name(db, plan_config["name"])
+        updates = []
+        created = False
+        for plan_config in _DEFAULT_PLANS:
+            # Copy so the ORM objects never share the module-level features dicts
+            plan_config = {**plan_config, "features": copy.deepcopy(plan_config["features"])}
+            existing = existing_map.get(plan_config["name"])
             
             if existing and not force:
                 logger.info(f"Plan '{plan_config['name']}' already exists, skipping")
                 plans.append(existing)
             elif existing and force:
-                # Update existing plan
-                for key, value in plan_config.items():
-                    if key != "name":  # Don't update name
-                        setattr(existing, key, value)
-                db.commit()
-                db.refresh(existing)
+                # Update existing plan (name is the lookup key and is not updated)
+                updates.append({
+                    "id": existing.id,
+                    **{key: value for key, value in plan_config.items() if key != "name"}
+                })
                 logger.info(f"Updated existing plan: {plan_config['name']}")
                 plans.append(existing)
             else:
                 # Create new plan
-                plan = self.create_plan(db, **plan_config)
+                plan = self.create_plan(db, **plan_config, commit=False)
                 plans.append(plan)
+                created = True
+        
+        if updates or created:
+            if updates:
+                # One executemany UPDATE, bypassing per-object change tracking
+                db.bulk_update_mappings(SubscriptionPlan, updates)
+            # Single commit for all creates/updates
+            db.commit()
+            for plan in plans:
+                db.refresh(plan)
+            self._invalidate_caches()
         
         return plans
     
@@ -296,10 +418,50 @@ class PlanService:
         Returns:
             Dictionary with plan details or None if not found
         """
+        now = time.monotonic()
+        with self._cache_lock:
+            cached = self._info_cache.get(plan_id)
+        if cached is not None and cached[1] > now:
+            return self._copy_info(cached[0])
+        
         plan = self.get_plan_by_id(db, plan_id)
         if not plan:
             return None
         
+        info = self._serialize_plan(plan)
+        with self._cache_lock:
+            self._info_cache[plan_id] = (info, now + PLAN_CACHE_TTL_SECONDS)
+        return self._copy_info(info)
+    
+    def get_active_plans_info(self, db: Session) -> List[Dict[str, Any]]:
+        """
+        Get plan information for all active plans
+        
+        Args:
+            db: Database session
+            
+        Returns:
+            List of plan info dictionaries (see get_plan_info), sorted by sort_order
+        """
+        now = time.monotonic()
+        with self._cache_lock:
+            cached = self._active_info_cache
+        if cached is not None and cached[1] > now:
+            return [self._copy_info(info) for info in cached[0]]
+        
+        infos = [self._serialize_plan(plan) for plan in self.get_all_active_plans(db)]
+        with self._cache_lock:
+            self._active_info_cache = (infos, now + PLAN_CACHE_TTL_SECONDS)
+        return [self._copy_info(info) for info in infos]
+    
+    @staticmethod
+    def _copy_info(info: Dict[str, Any]) -> Dict[str, Any]:
+        """Copy a cached plan info dict, including the nested features, so callers can't mutate the cache."""
+        return {**info, "features": copy.deepcopy(info["features"])}
+    
+    @staticmethod
+    def _serialize_plan(plan: SubscriptionPlan) -> Dict[str, Any]:
+        """Build the plain-dict representation returned by get_plan_info."""
         return {
             "id": plan.id,
             "name": plan.name,
@@ -308,10 +470,11 @@ class PlanService:
             "credits_per_month": plan.credits_per_month,
             "credits_per_analyze": plan.credits_per_analyze,
             "credits_per_edit": plan.credits_per_edit,
-            "features": plan.features or {},
+            "features": copy.deepcopy(plan.features or {}),
             "stripe_price_id": plan.stripe_price_id,  # Legacy
             "stripe_price_id_monthly": plan.stripe_price_id_monthly,
             "stripe_price_id_yearly": plan.stripe_price_id_yearly,
+            "stripe_product_id": plan.stripe_product_id,
             "is_active": plan.is_active
         }
 
@@ -1,10 +1,15 @@
 """
 Subscription service for managing user subscriptions and Stripe integration
 """
+from sqlalchemy import event, select, text, update
 from sqlalchemy.orm import Session
 from typing import Optional, Dict, Any
-from datetime import datetime
+from datetime import datetime, timezone
+from dataclasses import dataclass
 import logging
+import os
+import time
+import stripe
 
 from ..models import User, Subscription, SubscriptionPlan
 from .credit_service import credit_service
@@ -12,10 +17,94 @@ from .plan_service import plan_service
 
 logger = logging.getLogger(__name__)
 
+_UTC = timezone.utc
+
+
+# First key of the two-key advisory locks taken per user on subscription writes
+_SUBSCRIPTION_LOCK_NAMESPACE = 0x5355
+
+
+def _lock_user_subscription(db: Session, user_id: int) -> None:
+    """
+    Serialize subscription writes for one user until the current transaction ends.
+    
+    Concurrent Stripe webhooks for the same user otherwise race between reading the
+    latest subscription and updating/inserting it. Uses a PostgreSQL transaction-level
+    advisory lock; a no-op on other databases.
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(
+            text("SELECT pg_advisory_xact_lock(:namespace, :user_id)"),
+            {"namespace": _SUBSCRIPTION_LOCK_NAMESPACE, "user_id": user_id}
+        )
+
+
+def _from_stripe_ts(ts: int) -> datetime:
+    """Convert a Stripe epoch timestamp to naive UTC (not server local time)."""
+    return datetime.fromtimestamp(ts, _UTC).replace(tzinfo=None)
+
+
+def _first_item_id(stripe_subscription_data: Dict[str, Any]) -> Optional[str]:
+    """ID of the first subscription item in a Stripe subscription payload, if present."""
+    try:
+        return stripe_subscription_data["items"]["data"][0]["id"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+@dataclass(slots=True, frozen=True)
+class StripeSubPayload:
+    """The fields of a Stripe subscription object that we store, extracted and converted once."""
+    stripe_subscription_id: Optional[str]
+    stripe_customer_id: Optional[str]
+    status: str
+    current_period_start: Optional[datetime]  # Naive UTC
+    current_period_end: Optional[datetime]  # Naive UTC
+    cancel_at_period_end: bool
+    stripe_item_id: Optional[str]  # First subscription item, needed for plan changes
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "StripeSubPayload":
+        """Build from a Stripe subscription object (webhook payload or API response)."""
+        period_start = data.get("current_period_start")
+        period_end = data.get("current_period_end")
+        return cls(
+            stripe_subscription_id=data.get("id"),
+            stripe_customer_id=data.get("customer"),
+            status=data.get("status", "active"),
+            current_period_start=_from_stripe_ts(period_start) if period_start else None,
+            current_period_end=_from_stripe_ts(period_end) if period_end else None,
+            cancel_at_period_end=data.get("cancel_at_period_end", False),
+            stripe_item_id=_first_item_id(data)
+        )
+
+
+# Bound on remembered Stripe subscription item IDs
+STRIPE_ITEM_CACHE_MAX_ENTRIES = 4096
+
+# How long get_subscription_info remembers that a user has no subscription row.
+# Inserts in this process clear it immediately; other workers see them after the TTL.
+NO_SUBSCRIPTION_CACHE_TTL_SECONDS = float(os.getenv("NO_SUBSCRIPTION_CACHE_TTL_SECONDS", "10"))
+NO_SUBSCRIPTION_CACHE_MAX_ENTRIES = 4096
+
 
 class SubscriptionService:
     """Service for managing user subscriptions"""
     
+    def __init__(self):
+        # stripe_subscription_id -> subscription item ID, learned from webhooks and modify responses
+        self._stripe_item_ids: Dict[str, str] = {}
+        # user_id -> monotonic expiry of "this user has no subscription"
+        self._no_subscription_until: Dict[int, float] = {}
+    
+    def _remember_stripe_item(self, stripe_sub_id: Optional[str], item_id: Optional[str]) -> None:
+        """Record the subscription item ID of a Stripe subscription, if both are known."""
+        if not stripe_sub_id or not item_id:
+            return
+        if len(self._stripe_item_ids) >= STRIPE_ITEM_CACHE_MAX_ENTRIES:
+            self._stripe_item_ids.clear()
+        self._stripe_item_ids[stripe_sub_id] = item_id
+    
     def get_user_subscription(self, db: Session, user_id: int) -> Optional[Subscription]:
         """
         Get the active subscription for a user
@@ -27,19 +116,60 @@ class SubscriptionService:
         Returns:
             Subscription object or None if not found
         """
-        return (
-            db.query(Subscription)
-            .filter(Subscription.user_id == user_id)
+        # Served by ix_subscriptions_user_created
+        stmt = (
+            select(Subscription)
+            .where(Subscription.user_id == user_id)
             .order_by(Subscription.created_at.desc())
-            .first()
+            .limit(1)
         )
+        return db.execute(stmt).scalars().first()
+    
+    def _get_user_subscription_for_update(self, db: Session, user_id: int) -> Optional[Subscription]:
+        """
+        Get the latest subscription for a user, row-locked until the transaction ends
+        
+        Only for mutating paths; the advisory lock still covers users without a row yet.
+        
+        Args:
+            db: Database session
+            user_id: User ID
+            
+        Returns:
+            Subscription object or None if not found
+        """
+        stmt = (
+            select(Subscription)
+            .where(Subscription.user_id == user_id)
+            .order_by(Subscription.created_at.desc())
+            .limit(1)
+            .with_for_update()
+        )
+        return db.execute(stmt).scalars().first()
+    
+    def _get_subscription_for_update(
+        self,
+        db: Session,
+        user_id: int,
+        subscription_id: Optional[int] = None
+    ) -> Optional[Subscription]:
+        """
+        Row-lock the subscription to mutate: by primary key when the caller already knows it,
+        otherwise the user's latest subscription
+        """
+        if subscription_id is not None:
+            subscription = db.get(Subscription, subscription_id, with_for_update=True)
+            if subscription is not None and subscription.user_id == user_id:
+                return subscription
+        return self._get_user_subscription_for_update(db, user_id)
     
     def create_or_update_subscription(
         self,
         db: Session,
         user: User,
         plan_id: int,
-        stripe_subscription_data: Dict[str, Any]
+        payload: StripeSubPayload,
+        commit: bool = True
     ) -> Subscription:
         """
         Create or update a subscription from Stripe webhook data
@@ -48,68 +178,61 @@ class SubscriptionService:
             db: Database session
             user: User object
             plan_id: SubscriptionPlan ID
-            stripe_subscription_data: Data from Stripe subscription object
+            payload: Fields extracted from the Stripe subscription object
+            commit: If False, only flush so the caller can commit this together
+                with its own changes
             
         Returns:
             Created or updated Subscription object
         """
+        _lock_user_subscription(db, user.id)
+        
         # Check if subscription exists
-        existing = self.get_user_subscription(db, user.id)
-        
-        # Extract Stripe data
-        stripe_sub_id = stripe_subscription_data.get("id")
-        stripe_customer_id = stripe_subscription_data.get("customer")
-        status = stripe_subscription_data.get("status", "active")
-        current_period_start = stripe_subscription_data.get("current_period_start")
-        current_period_end = stripe_subscription_data.get("current_period_end")
-        cancel_at_period_end = stripe_subscription_data.get("cancel_at_period_end", False)
-        
-        # Convert timestamps if they exist
-        period_start = None
-        period_end = None
-        if current_period_start:
-            period_start = datetime.fromtimestamp(current_period_start)
-        if current_period_end:
-            period_end = datetime.fromtimestamp(current_period_end)
+        existing = self._get_user_subscription_for_update(db, user.id)
+        self._remember_stripe_item(payload.stripe_subscription_id, payload.stripe_item_id)
         
         if existing:
             # Update existing subscription
             existing.plan_id = plan_id
-            existing.status = status
-            existing.stripe_customer_id = stripe_customer_id
-            existing.stripe_subscription_id = stripe_sub_id
-            existing.current_period_start = period_start
-            existing.current_period_end = period_end
-            existing.cancel_at_period_end = cancel_at_period_end
-            existing.updated_at = datetime.utcnow()
+            existing.status = payload.status
+            existing.stripe_customer_id = payload.stripe_customer_id
+            existing.stripe_subscription_id = payload.stripe_subscription_id
+            existing.current_period_start = payload.current_period_start
+            existing.current_period_end = payload.current_period_end
+            existing.cancel_at_period_end = payload.cancel_at_period_end
             
-            db.commit()
-            db.refresh(existing)
-            logger.info(f"Updated subscription for user {user.id} to plan {plan_id}")
+            if commit:
+                db.commit()
+            else:
+                db.flush()
+            logger.info("Updated subscription for user %s to plan %s", user.id, plan_id)
             return existing
         else:
             # Create new subscription
             subscription = Subscription(
                 user_id=user.id,
                 plan_id=plan_id,
-                status=status,
-                stripe_customer_id=stripe_customer_id,
-                stripe_subscription_id=stripe_sub_id,
-                current_period_start=period_start,
-                current_period_end=period_end,
-                cancel_at_period_end=cancel_at_period_end
+                status=payload.status,
+                stripe_customer_id=payload.stripe_customer_id,
+                stripe_subscription_id=payload.stripe_subscription_id,
+                current_period_start=payload.current_period_start,
+                current_period_end=payload.current_period_end,
+                cancel_at_period_end=payload.cancel_at_period_end
             )
             db.add(subscription)
-            db.commit()
-            db.refresh(subscription)
-            logger.info(f"Created subscription for user {user.id} with plan {plan_id}")
+            if commit:
+                db.commit()
+            else:
+                db.flush()
+            logger.info("Created subscription for user %s with plan %s", user.id, plan_id)
             return subscription
     
     def cancel_subscription(
         self,
         db: Session,
         user_id: int,
-        immediate: bool = False
+        immediate: bool = False,
+        subscription_id: Optional[int] = None
     ) -> Optional[Subscription]:
         """
         Cancel a user's subscription
@@ -118,13 +241,15 @@ class SubscriptionService:
             db: Database session
             user_id: User ID
             immediate: If True, cancel immediately; if False, cancel at period end
+            subscription_id: The subscription's ID, if the caller already has it
             
         Returns:
             Updated Subscription object or None if not found
         """
-        subscription = self.get_user_subscription(db, user_id)
+        _lock_user_subscription(db, user_id)
+        subscription = self._get_subscription_for_update(db, user_id, subscription_id)
         if not subscription:
-            logger.warning(f"No subscription found for user {user_id}")
+            logger.warning("No subscription found for user %s", user_id)
             return None
         
         if immediate:
@@ -133,59 +258,66 @@ class SubscriptionService:
         else:
             subscription.cancel_at_period_end = True
         
-        subscription.updated_at = datetime.utcnow()
         db.commit()
-        db.refresh(subscription)
         
-        logger.info(f"Canceled subscription for user {user_id} (immediate={immediate})")
+        logger.info("Canceled subscription for user %s (immediate=%s)", user_id, immediate)
         return subscription
     
-    def downgrade_to_free(self, db: Session, user_id: int) -> Subscription:
+    def downgrade_to_free(
+        self,
+        db: Session,
+        user_id: int,
+        commit: bool = True,
+        subscription_id: Optional[int] = None
+    ) -> Subscription:
         """
         Downgrade a user to the free tier
         
         Args:
             db: Database session
             user_id: User ID
+            commit: If False, only flush so the caller can commit this together
+                with its own changes
+            subscription_id: The subscription's ID, if the caller already has it
             
         Returns:
             Updated or created Subscription object
         """
         # Get free plan
-        free_plan = plan_service.get_plan_by_name(db, "Free")
-        if not free_plan:
+        free_plan_id = plan_service.get_plan_id_by_name(db, "Free")
+        if free_plan_id is None:
             raise ValueError("Free plan not found in database")
         
+        _lock_user_subscription(db, user_id)
+        
         # Get or create subscription
-        subscription = self.get_user_subscription(db, user_id)
+        subscription = self._get_subscription_for_update(db, user_id, subscription_id)
         
         if subscription:
-            subscription.plan_id = free_plan.id
+            subscription.plan_id = free_plan_id
             subscription.status = "active"
             subscription.stripe_subscription_id = None
             subscription.cancel_at_period_end = False
-            subscription.updated_at = datetime.utcnow()
-            db.commit()
-            db.refresh(subscription)
         else:
             subscription = Subscription(
                 user_id=user_id,
-                plan_id=free_plan.id,
+                plan_id=free_plan_id,
                 status="active"
             )
             db.add(subscription)
-            db.commit()
-            db.refresh(subscription)
         
-        # Reset credits to free tier
+        # Reset credits to free tier, committed together with the subscription
         credit_service.reset_credits(
             db, 
             user_id, 
-            free_plan.id,
-            description="Downgraded to Free tier"
+            free_plan_id,
+            description="Downgraded to Free tier",
+            commit=False
         )
+        if commit:
+            db.commit()
         
-        logger.info(f"Downgraded user {user_id} to Free tier")
+        logger.info("Downgraded user %s to Free tier", user_id)
         return subscription
     
     def assign_free_tier(self, db: Session, user: User) -> Subscription:
@@ -200,36 +332,38 @@ class SubscriptionService:
             Created Subscription object
         """
         # Get free plan
-        free_plan = plan_service.get_plan_by_name(db, "Free")
-        if not free_plan:
+        free_plan_id = plan_service.get_plan_id_by_name(db, "Free")
+        if free_plan_id is None:
             raise ValueError("Free plan not found in database")
         
         # Create subscription
         subscription = Subscription(
             user_id=user.id,
-            plan_id=free_plan.id,
+            plan_id=free_plan_id,
             status="active"
         )
         db.add(subscription)
-        db.commit()
-        db.refresh(subscription)
         
-        # Initialize credits
+        # Initialize credits, committed together with the subscription
         credit_service.reset_credits(
             db,
             user.id,
-            free_plan.id,
-            description="New user - Free tier"
+            free_plan_id,
+            description="New user - Free tier",
+            commit=False
         )
+        db.commit()
         
-        logger.info(f"Assigned Free tier to new user {user.id}")
+        logger.info("Assigned Free tier to new user %s", user.id)
         return subscription
     
     def handle_payment_succeeded(
         self,
         db: Session,
         user_id: int,
-        stripe_invoice_data: Dict[str, Any]
+        stripe_invoice_data: Dict[str, Any],
+        commit: bool = True,
+        subscription_id: Optional[int] = None
     ) -> None:
         """
         Handle successful payment (monthly renewal) - reset credits
@@ -238,10 +372,14 @@ class SubscriptionService:
             db: Database session
             user_id: User ID
             stripe_invoice_data: Data from Stripe invoice object
+            commit: If False, only flush so the caller can commit this together
+                with its own changes
+            subscription_id: The subscription's ID, if the caller already has it
         """
-        subscription = self.get_user_subscription(db, user_id)
+        _lock_user_subscription(db, user_id)
+        subscription = self._get_subscription_for_update(db, user_id, subscription_id)
         if not subscription or not subscription.plan_id:
-            logger.warning(f"No subscription or plan found for user {user_id}")
+            logger.warning("No subscription or plan found for user %s", user_id)
             return
         
         # Reset credits to plan limit
@@ -249,16 +387,19 @@ class SubscriptionService:
             db,
             user_id,
             subscription.plan_id,
-            description="Monthly subscription renewal"
+            description="Monthly subscription renewal",
+            commit=commit
         )
         
-        logger.info(f"Reset credits for user {user_id} after successful payment")
+        logger.info("Reset credits for user %s after successful payment", user_id)
     
     def handle_payment_failed(
         self,
         db: Session,
         user_id: int,
-        stripe_invoice_data: Dict[str, Any]
+        stripe_invoice_data: Dict[str, Any],
+        commit: bool = True,
+        subscription_id: Optional[int] = None
     ) -> None:
         """
         Handle failed payment
@@ -267,18 +408,41 @@ class SubscriptionService:
             db: Database session
             user_id: User ID
             stripe_invoice_data: Data from Stripe invoice object
+            commit: If False, only flush so the caller can commit this together
+                with its own changes
+            subscription_id: The subscription's ID, if the caller already has it
         """
-        subscription = self.get_user_subscription(db, user_id)
-        if not subscription:
-            logger.warning(f"No subscription found for user {user_id}")
-            return
+        _lock_user_subscription(db, user_id)
+        if subscription_id is None:
+            # Same row _get_subscription_for_update would pick: the user's latest
+            subscription_id = (
+                select(Subscription.id)
+                .where(Subscription.user_id == user_id)
+                .order_by(Subscription.created_at.desc())
+                .limit(1)
+                .scalar_subquery()
+            )
         
-        # Mark subscription as past_due
-        subscription.status = "past_due"
-        subscription.updated_at = datetime.utcnow()
-        db.commit()
+        # Mark that one subscription past_due in a single UPDATE, without loading it;
+        # a canceled subscription is left as is. updated_at is set by the column's onupdate.
+        result = db.execute(
+            update(Subscription)
+            .where(
+                Subscription.id == subscription_id,
+                Subscription.user_id == user_id,
+                Subscription.status != "canceled"
+            )
+            .values(status="past_due")
+            .execution_options(synchronize_session=False)
+        )
+        if commit:
+            db.commit()
         
-        logger.warning(f"Payment failed for user {user_id}, subscription marked as past_due")
+        if result.rowcount == 0:
+            logger.warning("No subscription found for user %s", user_id)
+            return
+        
+        logger.warning("Payment failed for user %s, subscription marked as past_due", user_id)
     
     def change_plan(
         self,
@@ -299,8 +463,6 @@ class SubscriptionService:
         Returns:
             Updated Subscription object
         """
-        import stripe
-        
         subscription = self.get_user_subscription(db, user_id)
         if not subscription or not subscription.stripe_subscription_id:
             raise ValueError("No active Stripe subscription found")
@@ -319,46 +481,56 @@ class SubscriptionService:
         if not new_price_id:
             raise ValueError(f"Plan {new_plan.name} does not have a {billing_period} price ID")
         
-        # Get current Stripe subscription
-        stripe_sub = stripe.Subscription.retrieve(subscription.stripe_subscription_id)
+        def modify(item_id: str):
+            # Modify subscription in Stripe with immediate proration
+            return stripe.Subscription.modify(
+                subscription.stripe_subscription_id,
+                items=[{
+                    "id": item_id,
+                    "price": new_price_id,
+                }],
+                proration_behavior="always_invoice",
+                metadata={
+                    "user_id": str(user_id),
+                    "plan_id": str(new_plan_id),
+                    "billing_period": billing_period
+                }
+            )
         
-        # Get current subscription item ID
-        current_item_id = stripe_sub["items"]["data"][0]["id"]
+        def retrieve_item_id() -> str:
+            stripe_sub = stripe.Subscription.retrieve(subscription.stripe_subscription_id)
+            return stripe_sub["items"]["data"][0]["id"]
         
-        # Modify subscription in Stripe with immediate proration
-        updated_sub = stripe.Subscription.modify(
-            subscription.stripe_subscription_id,
-            items=[{
-                "id": current_item_id,
-                "price": new_price_id,
-            }],
-            proration_behavior="always_invoice",
-            metadata={
-                "user_id": str(user_id),
-                "plan_id": str(new_plan_id),
-                "billing_period": billing_period
-            }
-        )
+        # Skip the retrieve round trip when the item ID is already known
+        current_item_id = self._stripe_item_ids.get(subscription.stripe_subscription_id)
+        if current_item_id:
+            try:
+                updated_sub = modify(current_item_id)
+            except stripe.error.InvalidRequestError:
+                # Items were replaced outside this process; refetch once
+                self._stripe_item_ids.pop(subscription.stripe_subscription_id, None)
+                updated_sub = modify(retrieve_item_id())
+        else:
+            updated_sub = modify(retrieve_item_id())
+        self._remember_stripe_item(subscription.stripe_subscription_id, _first_item_id(updated_sub))
         
         # Update database subscription
         subscription.plan_id = new_plan_id
         subscription.status = updated_sub["status"]
-        subscription.current_period_start = datetime.fromtimestamp(updated_sub["current_period_start"])
-        subscription.current_period_end = datetime.fromtimestamp(updated_sub["current_period_end"])
-        subscription.updated_at = datetime.utcnow()
-        
-        db.commit()
-        db.refresh(subscription)
+        subscription.current_period_start = _from_stripe_ts(updated_sub["current_period_start"])
+        subscription.current_period_end = _from_stripe_ts(updated_sub["current_period_end"])
         
-        # Reset credits to new plan limit
+        # Reset credits to new plan limit, committed together with the subscription
         credit_service.reset_credits(
             db,
             user_id,
             new_plan_id,
-            description=f"Plan changed to {new_plan.name} ({billing_period})"
+            description=f"Plan changed to {new_plan.name} ({billing_period})",
+            commit=False
         )
+        db.commit()
         
-        logger.info(f"Changed plan for user {user_id} to {new_plan.name} ({billing_period})")
+        logger.info("Changed plan for user %s to %s (%s)", user_id, new_plan.name, billing_period)
         return subscription
     
     def reactivate_subscription(
@@ -376,11 +548,9 @@ class SubscriptionService:
         Returns:
             Updated Subscription object or None if not found
         """
-        import stripe
-        
         subscription = self.get_user_subscription(db, user_id)
         if not subscription or not subscription.stripe_subscription_id:
-            logger.warning(f"No subscription found for user {user_id}")
+            logger.warning("No subscription found for user %s", user_id)
             return None
         
         # Reactivate in Stripe
@@ -391,11 +561,9 @@ class SubscriptionService:
         
         # Update database
         subscription.cancel_at_period_end = False
-        subscription.updated_at = datetime.utcnow()
         db.commit()
-        db.refresh(subscription)
         
-        logger.info(f"Reactivated subscription for user {user_id}")
+        logger.info("Reactivated subscription for user %s", user_id)
         return subscription
     
     def get_subscription_info(self, db: Session, user_id: int) -> Dict[str, Any]:
@@ -409,14 +577,18 @@ class SubscriptionService:
         Returns:
             Dictionary with subscription details
         """
-        subscription = self.get_user_subscription(db, user_id)
+        now = time.monotonic()
+        if self._no_subscription_until.get(user_id, 0.0) > now:
+            subscription = None
+        else:
+            subscription = self.get_user_subscription(db, user_id)
+            if subscription is None:
+                if len(self._no_subscription_until) >= NO_SUBSCRIPTION_CACHE_MAX_ENTRIES:
+                    self._no_subscription_until.clear()
+                self._no_subscription_until[user_id] = now + NO_SUBSCRIPTION_CACHE_TTL_SECONDS
         
         # Get all available plans
-        all_plans = plan_service.get_all_active_plans(db)
-        available_plans = [
-            plan_service.get_plan_info(db, plan.id)
-            for plan in all_plans
-        ]
+        available_plans = plan_service.get_active_plans_info(db)
         
         if not subscription:
             return {
@@ -432,10 +604,16 @@ class SubscriptionService:
                 "cancel_at_period_end": False
             }
         
-        # Get plan info
+        # Get plan info, reusing the active plan list already loaded above
         plan_info = None
         if subscription.plan_id:
-            plan_info = plan_service.get_plan_info(db, subscription.plan_id)
+            plan_info = next(
+                (info for info in available_plans if info["id"] == subscription.plan_id),
+                None
+            )
+            if plan_info is None:
+                # Subscribed to a plan that has since been deactivated
+                plan_info = plan_service.get_plan_info(db, subscription.plan_id)
         
         # Get credit info
         credit_info = credit_service.get_balance_info(db, user_id)
@@ -450,7 +628,6 @@ class SubscriptionService:
         
         if subscription.stripe_subscription_id:
             try:
-                import stripe
                 stripe_sub = stripe.Subscription.retrieve(subscription.stripe_subscription_id)
                 
                 # Determine billing period from interval
@@ -463,7 +640,7 @@ class SubscriptionService:
                         price = stripe_sub["items"]["data"][0]["price"]
                         next_billing_amount = price.get("unit_amount", 0) / 100  # Convert from cents
             except Exception as e:
-                logger.warning(f"Could not fetch Stripe subscription details: {e}")
+                logger.warning("Could not fetch Stripe subscription details: %s", e)
         
         return {
             "has_subscription": True,
@@ -483,3 +660,9 @@ class SubscriptionService:
 # Singleton instance
 subscription_service = SubscriptionService()
 
+
+@event.listens_for(Subscription, "after_insert")
+def _forget_no_subscription(mapper, connection, target: Subscription) -> None:
+    # Covers every insert path, including credit_service creating the free-tier row
+    subscription_service._no_subscription_until.pop(target.user_id, None)
+
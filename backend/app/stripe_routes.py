@@ -1,19 +1,27 @@
 """
 Stripe payment and webhook routes for subscription management
 """
+import asyncio
 import os
+import threading
+import time
+import requests
 import stripe
+from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
 from fastapi import APIRouter, Header, HTTPException, Request, Depends
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 import logging
 
 from .core.db import get_db
 from .core.security import get_current_user
-from .models import User
-from .services.subscription_service import subscription_service
+from .models import User, Subscription, StripeEvent
+from .services.subscription_service import subscription_service, StripeSubPayload
 from .services.plan_service import plan_service
 from .services.credit_service import credit_service
 from pydantic import BaseModel
+from typing import Any, Callable, Dict, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +30,110 @@ router = APIRouter(prefix="/api/payment", tags=["payment"])
 # Initialize Stripe
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY", "sk_test_123")
 WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET", "whsec_test")
+FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:5173")
+# Checkout redirects; {CHECKOUT_SESSION_ID} is filled in by Stripe
+CHECKOUT_SUCCESS_URL = f"{FRONTEND_URL}/subscription?success=true&session_id={{CHECKOUT_SESSION_ID}}"
+CHECKOUT_CANCEL_URL = f"{FRONTEND_URL}/subscription?canceled=true"
+# Checkout session parameters that are the same for every request
+_BASE_CHECKOUT_PARAMS = {
+    "mode": "subscription",
+    "success_url": CHECKOUT_SUCCESS_URL,
+    "cancel_url": CHECKOUT_CANCEL_URL,
+}
+# Stripe event payloads stay well under this; anything larger is rejected before buffering it all
+STRIPE_WEBHOOK_MAX_BYTES = 1_048_576
+
+# Known promotion codes mapping (code -> Stripe promotion code ID)
+_KNOWN_PROMO_CODES: Dict[str, str] = {
+    "FIRST100": "promo_1SrJbKBACqQSnujJriPjszSv",  # 30% off
+}
+
+# One keep-alive pool for all Stripe calls; the stock client opens a session per threadpool thread
+_stripe_session = requests.Session()
+_stripe_session.mount("https://", HTTPAdapter(
+    pool_connections=int(os.getenv("STRIPE_HTTP_POOL_CONNECTIONS", "20")),
+    pool_maxsize=int(os.getenv("STRIPE_HTTP_POOL_MAXSIZE", "100")),
+))
+stripe.default_http_client = stripe.RequestsClient(
+    session=_stripe_session,
+    timeout=int(os.getenv("STRIPE_HTTP_TIMEOUT", "30")),
+)
+
+# Stripe catalog lookups that only change on dashboard edits; cleared by the
+# price.* / coupon.* / promotion_code.* webhooks, with the TTL as a backstop
+STRIPE_PRICE_CACHE_TTL_SECONDS = float(os.getenv("STRIPE_PRICE_CACHE_TTL_SECONDS", "86400"))
+STRIPE_PROMO_CACHE_TTL_SECONDS = float(os.getenv("STRIPE_PROMO_CACHE_TTL_SECONDS", "300"))
+STRIPE_LOOKUP_CACHE_MAX_ENTRIES = 1024
+_price_product_cache: Dict[str, Tuple[str, float]] = {}  # price_id -> (product_id, expires_at)
+_stripe_cache_lock = threading.Lock()
+# Every active promotion code (CODE -> fields we read), so unknown codes never reach Stripe
+_promo_catalog: Optional[Dict[str, Dict[str, Any]]] = None
+_promo_catalog_expires_at = 0.0
+_promo_catalog_lock = threading.Lock()  # Also makes concurrent misses share one reload
+
+
+# Processed event ids only need to outlive Stripe's retry window (up to 3 days)
+STRIPE_EVENT_RETENTION_DAYS = int(os.getenv("STRIPE_EVENT_RETENTION_DAYS", "7"))
+STRIPE_EVENT_PRUNE_INTERVAL_SECONDS = 3600
+_next_event_prune_at = 0.0  # time.monotonic() deadline, per process
+
+
+def _cache_put(cache: Dict[str, Tuple[Any, float]], key: str, value: Any, ttl: float) -> None:
+    with _stripe_cache_lock:
+        if len(cache) >= STRIPE_LOOKUP_CACHE_MAX_ENTRIES:
+            cache.clear()
+        cache[key] = (value, time.monotonic() + ttl)
+
+
+def get_cached_price_product_id(price_id: str) -> str:
+    """Product ID of a Stripe price, retrieving the price only on a cache miss."""
+    with _stripe_cache_lock:
+        cached = _price_product_cache.get(price_id)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+    
+    price = stripe.Price.retrieve(price_id)
+    product_id = price.product if isinstance(price.product, str) else price.product.id
+    _cache_put(_price_product_cache, price_id, product_id, STRIPE_PRICE_CACHE_TTL_SECONDS)
+    return product_id
+
+
+def _load_promo_catalog() -> Dict[str, Dict[str, Any]]:
+    """Fetch all active promotion codes from Stripe, keyed by upper-cased code."""
+    catalog = {}
+    # applies_to is only returned when expanded; without it product restrictions look absent
+    promo_codes = stripe.PromotionCode.list(
+        active=True,
+        limit=100,
+        expand=["data.coupon.applies_to"]
+    )
+    for promo_code_obj in promo_codes.auto_paging_iter():
+        coupon = promo_code_obj.coupon
+        catalog[promo_code_obj.code.upper()] = {
+            "id": promo_code_obj.id,
+            "valid": coupon.valid,
+            "percent_off": coupon.percent_off,
+            "amount_off": coupon.amount_off,
+            "applies_to_products": list(coupon.applies_to.products) if coupon.applies_to and coupon.applies_to.products else None,
+        }
+    return catalog
+
+
+def get_cached_promo(code_upper: str) -> Optional[Dict[str, Any]]:
+    """
+    Look up an active promotion code in the cached catalog of all active codes
+    
+    Returns:
+        Dict with the promotion code id and the coupon fields we read, or None if not found
+    """
+    global _promo_catalog, _promo_catalog_expires_at
+    with _promo_catalog_lock:
+        now = time.monotonic()
+        if _promo_catalog is None or _promo_catalog_expires_at <= now:
+            _promo_catalog = _load_promo_catalog()
+            _promo_catalog_expires_at = now + STRIPE_PROMO_CACHE_TTL_SECONDS
+        catalog = _promo_catalog
+    return catalog.get(code_upper)
 
 
 class CreateCheckoutRequest(BaseModel):
@@ -31,6 +143,110 @@ class CreateCheckoutRequest(BaseModel):
     promo_code: str | None = None  # Optional promo code
 
 
+def _build_checkout_session(
+    db: Session,
+    user: User,
+    plan_id: int,
+    billing_period: str,
+    existing_subscription: Optional[Subscription],
+    promo_code: Optional[str] = None
+):
+    """
+    Create a Stripe Checkout session for a plan, shared by checkout and the change-plan fallback
+    
+    Args:
+        db: Database session
+        user: User checking out
+        plan_id: Plan to subscribe to
+        billing_period: "monthly" or "yearly"
+        existing_subscription: The user's latest subscription, to reuse its Stripe customer
+        promo_code: Optional promo code to pre-apply
+        
+    Returns:
+        stripe.checkout.Session
+    """
+    # Get plan details
+    plan = plan_service.get_plan_info(db, plan_id)
+    if not plan:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    
+    # Determine which price ID to use based on billing period
+    billing_period = billing_period.lower()
+    if billing_period == "yearly":
+        price_id = plan["stripe_price_id_yearly"]
+        if not price_id:
+            raise HTTPException(status_code=400, detail="Plan does not have a yearly Stripe price ID")
+    else:  # Default to monthly
+        price_id = plan["stripe_price_id_monthly"] or plan["stripe_price_id"]  # Fallback to legacy field
+        if not price_id:
+            raise HTTPException(status_code=400, detail="Plan does not have a monthly Stripe price ID")
+    
+    # Get or create Stripe customer
+    customer_id = existing_subscription.stripe_customer_id if existing_subscription else None
+    
+    if not customer_id:
+        # Create new Stripe customer
+        customer = stripe.Customer.create(
+            email=user.email,
+            name=user.name,
+            metadata={
+                "user_id": str(user.id)
+            }
+        )
+        customer_id = customer.id
+        logger.info(f"Created Stripe customer {customer_id} for user {user.id}")
+    
+    # Apply promo code if provided
+    discounts = None
+    if promo_code:
+        promo_code_upper = promo_code.upper()
+        
+        # Check if it's a known promo code with direct ID
+        if promo_code_upper in _KNOWN_PROMO_CODES:
+            discounts = [{"promotion_code": _KNOWN_PROMO_CODES[promo_code_upper]}]
+            logger.info(f"Applied known promo code {promo_code_upper}")
+        else:
+            # Try to look up other promo codes from Stripe
+            try:
+                promo = get_cached_promo(promo_code_upper)
+                
+                if promo:
+                    discounts = [{"promotion_code": promo["id"]}]
+                    logger.info(f"Applied promo code {promo_code_upper} from Stripe lookup")
+                else:
+                    logger.warning(f"Invalid promo code {promo_code}, proceeding without discount")
+            except Exception as promo_error:
+                logger.warning(f"Error validating promo code {promo_code}: {promo_error}, proceeding without discount")
+    
+    # Create checkout session
+    session_params = {
+        **_BASE_CHECKOUT_PARAMS,
+        "customer": customer_id,
+        "line_items": [{
+            "price": price_id,
+            "quantity": 1
+        }],
+        "metadata": {
+            "user_id": str(user.id),
+            "plan_id": str(plan["id"]),
+            "billing_period": billing_period
+        }
+    }
+    
+    # Add discounts if promo code is valid, otherwise allow manual entry
+    # Note: Stripe doesn't allow both discounts and allow_promotion_codes together
+    if discounts:
+        session_params["discounts"] = discounts
+    else:
+        # Only allow manual promo code entry if no discount is pre-applied
+        session_params["allow_promotion_codes"] = True
+    
+    session = stripe.checkout.Session.create(**session_params)
+    
+    logger.info(f"Created checkout session {session.id} for user {user.id}, plan {plan['name']}")
+    return session
+
+
 @router.post("/create-checkout-session")
 def create_checkout_session(
     request: CreateCheckoutRequest,
@@ -49,98 +265,16 @@ def create_checkout_session(
         Dictionary with checkoutUrl
     """
     try:
-        # Get plan details
-        plan = plan_service.get_plan_by_id(db, request.plan_id)
-        if not plan:
-            raise HTTPException(status_code=404, detail="Plan not found")
-        
-        # Determine which price ID to use based on billing period
-        billing_period = request.billing_period.lower()
-        if billing_period == "yearly":
-            price_id = plan.stripe_price_id_yearly
-            if not price_id:
-                raise HTTPException(status_code=400, detail="Plan does not have a yearly Stripe price ID")
-        else:  # Default to monthly
-            price_id = plan.stripe_price_id_monthly or plan.stripe_price_id  # Fallback to legacy field
-            if not price_id:
-                raise HTTPException(status_code=400, detail="Plan does not have a monthly Stripe price ID")
-        
-        # Get or create Stripe customer
+        # Latest subscription, to reuse its Stripe customer
         existing_subscription = subscription_service.get_user_subscription(db, current_user.id)
-        customer_id = existing_subscription.stripe_customer_id if existing_subscription else None
-        
-        if not customer_id:
-            # Create new Stripe customer
-            customer = stripe.Customer.create(
-                email=current_user.email,
-                name=current_user.name,
-                metadata={
-                    "user_id": current_user.id
-                }
-            )
-            customer_id = customer.id
-            logger.info(f"Created Stripe customer {customer_id} for user {current_user.id}")
-        
-        # Known promotion codes mapping (code -> Stripe promotion code ID)
-        KNOWN_PROMO_CODES = {
-            "FIRST100": "promo_1SrJbKBACqQSnujJriPjszSv",  # 30% off
-        }
-        
-        # Apply promo code if provided
-        discounts = None
-        if request.promo_code:
-            promo_code_upper = request.promo_code.upper()
-            
-            # Check if it's a known promo code with direct ID
-            if promo_code_upper in KNOWN_PROMO_CODES:
-                discounts = [{"promotion_code": KNOWN_PROMO_CODES[promo_code_upper]}]
-                logger.info(f"Applied known promo code {promo_code_upper}")
-            else:
-                # Try to look up other promo codes from Stripe
-                try:
-                    promo_codes = stripe.PromotionCode.list(
-                        active=True,
-                        code=promo_code_upper,
-                        limit=1
-                    )
-                    
-                    if promo_codes.data:
-                        discounts = [{"promotion_code": promo_codes.data[0].id}]
-                        logger.info(f"Applied promo code {promo_code_upper} from Stripe lookup")
-                    else:
-                        logger.warning(f"Invalid promo code {request.promo_code}, proceeding without discount")
-                except Exception as promo_error:
-                    logger.warning(f"Error validating promo code {request.promo_code}: {promo_error}, proceeding without discount")
-        
-        # Create checkout session
-        domain = os.getenv("FRONTEND_URL", "http://localhost:5173")
-        session_params = {
-            "customer": customer_id,
-            "mode": "subscription",
-            "line_items": [{
-                "price": price_id,
-                "quantity": 1
-            }],
-            "success_url": f"{domain}/subscription?success=true&session_id={{CHECKOUT_SESSION_ID}}",
-            "cancel_url": f"{domain}/subscription?canceled=true",
-            "metadata": {
-                "user_id": str(current_user.id),
-                "plan_id": str(plan.id),
-                "billing_period": billing_period
-            }
-        }
-        
-        # Add discounts if promo code is valid, otherwise allow manual entry
-        # Note: Stripe doesn't allow both discounts and allow_promotion_codes together
-        if discounts:
-            session_params["discounts"] = discounts
-        else:
-            # Only allow manual promo code entry if no discount is pre-applied
-            session_params["allow_promotion_codes"] = True
-        
-        session = stripe.checkout.Session.create(**session_params)
-        
-        logger.info(f"Created checkout session {session.id} for user {current_user.id}, plan {plan.name}")
+        session = _build_checkout_session(
+            db,
+            current_user,
+            request.plan_id,
+            request.billing_period,
+            existing_subscription,
+            promo_code=request.promo_code
+        )
         return {"checkoutUrl": session.url}
         
     except stripe.error.StripeError as e:
@@ -179,7 +313,9 @@ def cancel_subscription(
         )
         
         # Update in database
-        subscription_service.cancel_subscription(db, current_user.id, immediate=False)
+        subscription_service.cancel_subscription(
+            db, current_user.id, immediate=False, subscription_id=user_subscription.id
+        )
         
         logger.info(f"Canceled subscription for user {current_user.id}")
         return {"message": "Subscription will be canceled at the end of the billing period"}
@@ -247,48 +383,12 @@ def change_plan(
             # No Stripe subscription - redirect to checkout instead
             logger.info(f"User {current_user.id} has no Stripe subscription, creating checkout session")
             
-            # Get plan details
-            plan = plan_service.get_plan_by_id(db, request.plan_id)
-            if not plan:
-                raise HTTPException(status_code=404, detail="Plan not found")
-            
-            # Determine which price ID to use based on billing period
-            billing_period = request.billing_period.lower()
-            if billing_period == "yearly":
-                price_id = plan.stripe_price_id_yearly
-                if not price_id:
-                    raise HTTPException(status_code=400, detail="Plan does not have a yearly Stripe price ID")
-            else:
-                price_id = plan.stripe_price_id_monthly or plan.stripe_price_id
-                if not price_id:
-                    raise HTTPException(status_code=400, detail="Plan does not have a monthly Stripe price ID")
-            
-            # Get or create Stripe customer
-            customer_id = user_subscription.stripe_customer_id if user_subscription else None
-            
-            if not customer_id:
-                customer = stripe.Customer.create(
-                    email=current_user.email,
-                    name=current_user.name,
-                    metadata={"user_id": str(current_user.id)}
-                )
-                customer_id = customer.id
-                logger.info(f"Created Stripe customer {customer_id} for user {current_user.id}")
-            
-            # Create checkout session
-            domain = os.getenv("FRONTEND_URL", "http://localhost:5173")
-            session = stripe.checkout.Session.create(
-                customer=customer_id,
-                mode="subscription",
-                line_items=[{"price": price_id, "quantity": 1}],
-                success_url=f"{domain}/subscription?success=true&session_id={{CHECKOUT_SESSION_ID}}",
-                cancel_url=f"{domain}/subscription?canceled=true",
-                allow_promotion_codes=True,
-                metadata={
-                    "user_id": str(current_user.id),
-                    "plan_id": str(plan.id),
-                    "billing_period": billing_period
-                }
+            session = _build_checkout_session(
+                db,
+                current_user,
+                request.plan_id,
+                request.billing_period,
+                user_subscription
             )
             
             return {
@@ -383,58 +483,50 @@ def validate_promo_code(
     """
     try:
         # Get plan to find product/price ID
-        plan = plan_service.get_plan_by_id(db, request.plan_id)
+        plan = plan_service.get_plan_info(db, request.plan_id)
         if not plan:
             raise HTTPException(status_code=404, detail="Plan not found")
         
         # Get price ID based on billing period
         if request.billing_period.lower() == "yearly":
-            price_id = plan.stripe_price_id_yearly
+            price_id = plan["stripe_price_id_yearly"]
         else:
-            price_id = plan.stripe_price_id_monthly or plan.stripe_price_id
+            price_id = plan["stripe_price_id_monthly"] or plan["stripe_price_id"]
         
         if not price_id:
             raise HTTPException(status_code=400, detail=f"Plan does not have a {request.billing_period} price ID")
         
-        # Get price object to find product ID
-        price = stripe.Price.retrieve(price_id)
-        product_id = price.product if isinstance(price.product, str) else price.product.id
+        # Product ID from the plan when configured, otherwise from the price object
+        product_id = plan["stripe_product_id"] or get_cached_price_product_id(price_id)
         
         # Search for promotion code
-        promo_codes = stripe.PromotionCode.list(
-            active=True,
-            code=request.promo_code.upper(),
-            limit=1
-        )
+        promo = get_cached_promo(request.promo_code.upper())
         
-        if not promo_codes.data:
+        if not promo:
             return {
                 "valid": False,
                 "error_message": "Promo code not found or inactive"
             }
         
-        promo_code_obj = promo_codes.data[0]
-        coupon = promo_code_obj.coupon
-        
         # Check if coupon applies to specific products
-        if coupon.applies_to and coupon.applies_to.products:
+        if promo["applies_to_products"]:
             # Coupon is product-specific
-            if product_id not in coupon.applies_to.products:
+            if product_id not in promo["applies_to_products"]:
                 return {
                     "valid": False,
-                    "error_message": f"Promo code does not apply to {plan.name} plan"
+                    "error_message": f"Promo code does not apply to {plan['name']} plan"
                 }
         
         # Check if coupon is valid (not expired, within usage limits)
-        if coupon.valid:
-            discount_percent = coupon.percent_off
-            discount_amount = coupon.amount_off / 100 if coupon.amount_off else None  # Convert from cents
+        if promo["valid"]:
+            discount_percent = promo["percent_off"]
+            discount_amount = promo["amount_off"] / 100 if promo["amount_off"] else None  # Convert from cents
             
             return {
                 "valid": True,
                 "discount_percent": discount_percent,
                 "discount_amount": discount_amount,
-                "promo_code_id": promo_code_obj.id
+                "promo_code_id": promo["id"]
             }
         else:
             return {
@@ -471,6 +563,7 @@ async def webhook(
     - customer.subscription.deleted: Subscription canceled
     - invoice.payment_succeeded: Payment successful (reset credits)
     - invoice.payment_failed: Payment failed
+    - price.*, coupon.*, promotion_code.*: Catalog edited (clear cached lookups)
     
     Args:
         request: FastAPI request object
@@ -480,7 +573,16 @@ async def webhook(
     Returns:
         Success response
     """
-    payload = await request.body()
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > STRIPE_WEBHOOK_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Payload too large")
+    
+    buf = bytearray()
+    async for chunk in request.stream():
+        buf += chunk
+        if len(buf) > STRIPE_WEBHOOK_MAX_BYTES:
+            raise HTTPException(status_code=413, detail="Payload too large")
+    payload = bytes(buf)
     
     try:
         # Verify webhook signature
@@ -498,44 +600,106 @@ async def webhook(
     
     event_type = event.get("type")
     event_data = event.get("data", {}).get("object", {})
+    event_id = event.get("id")
     
     logger.info(f"Received Stripe webhook: {event_type}")
     
+    # Handlers make blocking DB and Stripe calls; keep them off the event loop.
+    # The response still waits for the commit, so a failure is retried by Stripe.
+    return await asyncio.to_thread(_process_webhook_event, db, event_id, event_type, event_data)
+
+
+def _process_webhook_event(db: Session, event_id: Optional[str], event_type: str, event_data: dict) -> dict:
+    """
+    Claim, handle and commit one verified Stripe event (runs in a worker thread)
+    
+    Returns:
+        Webhook response body
+    """
+    # Claim the event id; Stripe may deliver the same event more than once or in parallel.
+    # The primary key makes the claim atomic, so only one delivery runs the handlers.
+    # The claim is only flushed: it commits together with the handler's changes below.
+    if event_id:
+        try:
+            db.add(StripeEvent(event_id=event_id, event_type=event_type))
+            db.flush()
+        except IntegrityError:
+            db.rollback()
+            logger.info(f"Skipping duplicate Stripe webhook {event_id} ({event_type})")
+            return {"received": True, "type": event_type, "duplicate": True}
+    
     try:
-        # Handle checkout.session.completed
-        if event_type == "checkout.session.completed":
-            await handle_checkout_completed(db, event_data)
-        
-        # Handle customer.subscription.updated
-        elif event_type == "customer.subscription.updated":
-            await handle_subscription_updated(db, event_data)
-        
-        # Handle customer.subscription.deleted
-        elif event_type == "customer.subscription.deleted":
-            await handle_subscription_deleted(db, event_data)
-        
-        # Handle invoice.payment_succeeded
-        elif event_type == "invoice.payment_succeeded":
-            await handle_payment_succeeded(db, event_data)
-        
-        # Handle invoice.payment_failed
-        elif event_type == "invoice.payment_failed":
-            await handle_payment_failed(db, event_data)
-        
+        handler = _WEBHOOK_HANDLERS.get(event_type)
+        if handler:
+            handler(db, event_data)
         else:
             logger.info(f"Unhandled event type: {event_type}")
         
-        return {"received": True, "type": event_type}
+        # Single commit for the event claim and everything the handler changed
+        db.commit()
         
     except Exception as e:
-        logger.error(f"Error processing webhook {event_type}: {e}")
-        import traceback
-        traceback.print_exc()
-        # Don't raise error - return 200 to prevent Stripe retries
-        return {"received": True, "error": str(e)}
+        logger.exception(f"Error processing webhook {event_type}: {e}")
+        # Nothing was committed, including the claim, so Stripe's retry redoes the whole event
+        db.rollback()
+        raise HTTPException(status_code=500, detail="Error processing webhook")
+    
+    _prune_stripe_events(db)
+    return {"received": True, "type": event_type}
+
+
+def _prune_stripe_events(db: Session) -> None:
+    """Delete event ids past the retention window, at most once per interval per process"""
+    global _next_event_prune_at
+    now = time.monotonic()
+    if now < _next_event_prune_at:
+        return
+    _next_event_prune_at = now + STRIPE_EVENT_PRUNE_INTERVAL_SECONDS
+    
+    cutoff = datetime.utcnow() - timedelta(days=STRIPE_EVENT_RETENTION_DAYS)
+    try:
+        deleted = db.query(StripeEvent).filter(StripeEvent.processed_at < cutoff).delete(
+            synchronize_session=False
+        )
+        db.commit()
+        if deleted:
+            logger.info(f"Pruned {deleted} Stripe events older than {STRIPE_EVENT_RETENTION_DAYS} days")
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Could not prune Stripe events: {e}")
 
 
-async def handle_checkout_completed(db: Session, session_data: dict):
+def _user_id_for_customer(db: Session, customer_id: str) -> Optional[int]:
+    """
+    User who owns a Stripe customer, or None if no subscription references it.
+    
+    Only resolves the user: the subscription service picks the row to change
+    (the user's latest) under its own lock, so a stale or canceled row for the
+    same customer is never targeted.
+    """
+    # Only the key is needed; skip hydrating the full row (ix on stripe_customer_id)
+    row = db.query(Subscription.user_id).filter(
+        Subscription.stripe_customer_id == customer_id
+    ).order_by(Subscription.created_at.desc()).first()
+    return row.user_id if row else None
+
+
+def handle_catalog_updated(db: Session, object_data: dict):
+    """
+    Handle price/coupon/promotion code events
+    Drops the cached Stripe catalog lookups so the next request refetches them
+    """
+    global _promo_catalog
+    if object_data.get("object") == "price":
+        with _stripe_cache_lock:
+            _price_product_cache.pop(object_data.get("id"), None)
+    else:
+        # A coupon can back many codes; reload the whole catalog on next use
+        with _promo_catalog_lock:
+            _promo_catalog = None
+
+
+def handle_checkout_completed(db: Session, session_data: dict):
     """
     Handle checkout.session.completed event
     Creates subscription and assigns plan to user
@@ -563,13 +727,14 @@ async def handle_checkout_completed(db: Session, session_data: dict):
         
         # Create or update subscription in database
         subscription_service.create_or_update_subscription(
-            db, user, plan_id, stripe_subscription
+            db, user, plan_id, StripeSubPayload.from_dict(stripe_subscription), commit=False
         )
         
         # Reset credits to new plan
         credit_service.reset_credits(
             db, user_id, plan_id,
-            description="Subscription created"
+            description="Subscription created",
+            commit=False
         )
         
         logger.info(f"Completed checkout for user {user_id}, plan {plan_id}")
@@ -577,7 +742,7 @@ async def handle_checkout_completed(db: Session, session_data: dict):
         logger.warning(f"No subscription ID in checkout session")
 
 
-async def handle_subscription_updated(db: Session, subscription_data: dict):
+def handle_subscription_updated(db: Session, subscription_data: dict):
     """
     Handle customer.subscription.updated event
     Updates subscription status and plan
@@ -589,32 +754,26 @@ async def handle_subscription_updated(db: Session, subscription_data: dict):
         return
     
     # Find user by stripe_customer_id
-    from .models import Subscription as SubscriptionModel
-    subscription = db.query(SubscriptionModel).filter(
-        SubscriptionModel.stripe_customer_id == customer_id
-    ).first()
-    
-    if not subscription:
+    user_id = _user_id_for_customer(db, customer_id)
+    if user_id is None:
         logger.warning(f"No subscription found for customer {customer_id}")
         return
     
-    user_id = subscription.user_id
-    
     # Get plan from price ID
     price_id = subscription_data.get("items", {}).get("data", [{}])[0].get("price", {}).get("id")
     if price_id:
-        plan = plan_service.get_plan_by_stripe_price_id(db, price_id)
-        if plan:
+        plan_id = plan_service.get_plan_id_by_stripe_price_id(db, price_id)
+        if plan_id is not None:
             # Update subscription
             user = db.query(User).filter(User.id == user_id).first()
             if user:
                 subscription_service.create_or_update_subscription(
-                    db, user, plan.id, subscription_data
+                    db, user, plan_id, StripeSubPayload.from_dict(subscription_data), commit=False
                 )
                 logger.info(f"Updated subscription for user {user_id}")
 
 
-async def handle_subscription_deleted(db: Session, subscription_data: dict):
+def handle_subscription_deleted(db: Session, subscription_data: dict):
     """
     Handle customer.subscription.deleted event
     Downgrades user to free tier
@@ -626,23 +785,17 @@ async def handle_subscription_deleted(db: Session, subscription_data: dict):
         return
     
     # Find user by stripe_customer_id
-    from .models import Subscription as SubscriptionModel
-    subscription = db.query(SubscriptionModel).filter(
-        SubscriptionModel.stripe_customer_id == customer_id
-    ).first()
-    
-    if not subscription:
+    user_id = _user_id_for_customer(db, customer_id)
+    if user_id is None:
         logger.warning(f"No subscription found for customer {customer_id}")
         return
     
-    user_id = subscription.user_id
-    
     # Downgrade to free tier
-    subscription_service.downgrade_to_free(db, user_id)
+    subscription_service.downgrade_to_free(db, user_id, commit=False)
     logger.info(f"Downgraded user {user_id} to free tier after subscription deletion")
 
 
-async def handle_payment_succeeded(db: Session, invoice_data: dict):
+def handle_payment_succeeded(db: Session, invoice_data: dict):
     """
     Handle invoice.payment_succeeded event
     Resets user credits on successful monthly payment
@@ -660,23 +813,17 @@ async def handle_payment_succeeded(db: Session, invoice_data: dict):
         return
     
     # Find user by stripe_customer_id
-    from .models import Subscription as SubscriptionModel
-    subscription = db.query(SubscriptionModel).filter(
-        SubscriptionModel.stripe_customer_id == customer_id
-    ).first()
-    
-    if not subscription:
+    user_id = _user_id_for_customer(db, customer_id)
+    if user_id is None:
         logger.warning(f"No subscription found for customer {customer_id}")
         return
     
-    user_id = subscription.user_id
-    
     # Reset credits
-    subscription_service.handle_payment_succeeded(db, user_id, invoice_data)
+    subscription_service.handle_payment_succeeded(db, user_id, invoice_data, commit=False)
     logger.info(f"Reset credits for user {user_id} after successful payment")
 
 
-async def handle_payment_failed(db: Session, invoice_data: dict):
+def handle_payment_failed(db: Session, invoice_data: dict):
     """
     Handle invoice.payment_failed event
     Marks subscription as past_due
@@ -688,17 +835,27 @@ async def handle_payment_failed(db: Session, invoice_data: dict):
         return
     
     # Find user by stripe_customer_id
-    from .models import Subscription as SubscriptionModel
-    subscription = db.query(SubscriptionModel).filter(
-        SubscriptionModel.stripe_customer_id == customer_id
-    ).first()
-    
-    if not subscription:
+    user_id = _user_id_for_customer(db, customer_id)
+    if user_id is None:
         logger.warning(f"No subscription found for customer {customer_id}")
         return
     
-    user_id = subscription.user_id
-    
     # Handle failed payment
-    subscription_service.handle_payment_failed(db, user_id, invoice_data)
+    subscription_service.handle_payment_failed(db, user_id, invoice_data, commit=False)
     logger.warning(f"Payment failed for user {user_id}")
+
+
+# Stripe event type -> handler, looked up by webhook()
+_WEBHOOK_HANDLERS: Dict[str, Callable[[Session, dict], None]] = {
+    "checkout.session.completed": handle_checkout_completed,
+    "customer.subscription.updated": handle_subscription_updated,
+    "customer.subscription.deleted": handle_subscription_deleted,
+    "invoice.payment_succeeded": handle_payment_succeeded,
+    "invoice.payment_failed": handle_payment_failed,
+    "price.updated": handle_catalog_updated,
+    "price.deleted": handle_catalog_updated,
+    "coupon.updated": handle_catalog_updated,
+    "coupon.deleted": handle_catalog_updated,
+    "promotion_code.created": handle_catalog_updated,
+    "promotion_code.updated": handle_catalog_updated,
+}
@@ -0,0 +1,5 @@
+import os
+
+# Settings read at import time by app modules; keep tests off real services
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
@@ -0,0 +1,35 @@
+import pandas as pd
+import pytest
+
+from app.services.dataset_service import DatasetService
+
+
+@pytest.fixture
+def service():
+    service = DatasetService()
+    service.store_dataset(1, "upload_test", pd.DataFrame({"a": [1, 2, 3]}), "data.csv")
+    return service
+
+
+def _add_chart(service, chart_index, title):
+    service.set_chart_metadata(1, "upload_test", chart_index, "fig = None", {}, title=title)
+
+
+def test_delete_chart_metadata_compacts_gaps(service):
+    _add_chart(service, 0, "first")
+    _add_chart(service, 2, "third")
+    
+    assert service.delete_chart_metadata(1, "upload_test", 0)
+    
+    remaining = service.get_chart_metadata(1, "upload_test", 0)
+    assert remaining["title"] == "third"
+    assert remaining["chart_index"] == 0
+    assert service.get_chart_metadata(1, "upload_test", 1) is None
+
+
+def test_delete_chart_metadata_missing_index(service):
+    _add_chart(service, 0, "first")
+    
+    assert not service.delete_chart_metadata(1, "upload_test", 1)
+    assert not service.delete_chart_metadata(1, "upload_test", 5)
+    assert service.get_chart_metadata(1, "upload_test", 0)["title"] == "first"